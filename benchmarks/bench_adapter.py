@@ -0,0 +1,482 @@
+"""Benchmarks of the adapter operations at scale.
+
+Every operation runs against a freshly seeded SQLite database, in memory or
+file-backed, and reports wall time, peak Python memory and the number of SQL
+statements. Results can be stored as a baseline and later runs compared to it:
+
+    python benchmarks/bench_adapter.py --sizes 10000 100000 --save-baseline
+    python benchmarks/bench_adapter.py --sizes 10000 100000 --compare
+
+Comparing exits with status 1 when an operation got slower or used more memory
+than the threshold allows, or issued more statements than the baseline.
+Timings depend on the machine, record the baseline on the machine you compare on.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import casbin
+from sqlalchemy import Boolean, Column, Integer, String, create_engine, event, insert
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from casbin_sqlalchemy_adapter import Adapter, Base, CasbinRule  # noqa: E402
+from casbin_sqlalchemy_adapter.adapter import Filter  # noqa: E402
+from casbin_sqlalchemy_adapter.bulk_load import BulkLoader  # noqa: E402
+from casbin_sqlalchemy_adapter.sqlite_profile import create_sqlite_engine  # noqa: E402
+
+MODEL = """
+[request_definition]
+r = sub, obj, act
+
+[policy_definition]
+p = sub, obj, act
+
+[role_definition]
+g = _, _
+
+[policy_effect]
+e = some(where (p.eft == allow))
+
+[matchers]
+m = g(r.sub, p.sub) && r.obj == p.obj && r.act == p.act
+"""
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+class BenchRuleSoftDelete(Base):
+    __tablename__ = "casbin_rule_bench_soft_delete"
+
+    id = Column(Integer, primary_key=True)
+    ptype = Column(String(255))
+    v0 = Column(String(255))
+    v1 = Column(String(255))
+    v2 = Column(String(255))
+    v3 = Column(String(255))
+    v4 = Column(String(255))
+    v5 = Column(String(255))
+    is_deleted = Column(Boolean, default=False, index=True, nullable=False)
+
+
+class BenchRuleIndexed(Base):
+    __tablename__ = "casbin_rule_bench_indexed"
+
+    id = Column(Integer, primary_key=True)
+    ptype = Column(String(255))
+    v0 = Column(String(255))
+    v1 = Column(String(255))
+    v2 = Column(String(255))
+    v3 = Column(String(255))
+    v4 = Column(String(255))
+    v5 = Column(String(255))
+
+
+def rule(i):
+    return ["user{}".format(i), "data{}".format(i % 100), ("read", "write")[i % 2]]
+
+
+def new_model():
+    model = casbin.model.Model()
+    model.load_model_from_text(MODEL)
+    return model
+
+
+def model_with(rules):
+    model = new_model()
+    model.model["p"]["p"].policy.extend(rules)
+    return model
+
+
+class Setup:
+    """A seeded database and the adapter under test."""
+
+    def __init__(self, database, size, table="plain"):
+        self.size = size
+        # also holds the files of the adapter, e.g. its policy store
+        self.tmpdir = tempfile.TemporaryDirectory()
+        if database == "file":
+            url = "sqlite:///" + os.path.join(self.tmpdir.name, "bench.db")
+        else:
+            url = "sqlite://"
+        if table == "profiled":
+            self.engine = create_sqlite_engine(url)
+        else:
+            self.engine = create_engine(url)
+        if table == "softdelete":
+            db_class = BenchRuleSoftDelete
+            self.adapter = Adapter(
+                self.engine, db_class, BenchRuleSoftDelete.is_deleted
+            )
+        elif table == "indexed":
+            db_class = BenchRuleIndexed
+            self.adapter = Adapter(self.engine, db_class, index_rules=True)
+        else:
+            db_class = CasbinRule
+            self.adapter = Adapter(self.engine)
+
+        with self.engine.begin() as conn:
+            conn.execute(db_class.__table__.delete())
+            for start in range(0, size, 10000):
+                conn.execute(
+                    insert(db_class.__table__),
+                    [
+                        dict(ptype="p", v0=v0, v1=v1, v2=v2)
+                        for v0, v1, v2 in map(
+                            rule, range(start, min(size, start + 10000))
+                        )
+                    ],
+                )
+
+    def close(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+def batch(size):
+    return max(1, size // 10)
+
+
+def bench_load_policy(setup):
+    model = new_model()
+    return lambda: setup.adapter.load_policy(model)
+
+
+def bench_load_policy_parallel(setup):
+    adapter = Adapter(setup.engine, create_all_models=False, load_workers=4)
+    model = new_model()
+    return lambda: adapter.load_policy(model)
+
+
+def bench_load_policy_store(setup):
+    # a worker filling its model from the version published by another process
+    store = os.path.join(setup.tmpdir.name, "store")
+    Adapter(setup.engine, create_all_models=False, policy_store=store).publish_policy()
+    adapter = Adapter(setup.engine, create_all_models=False, policy_store=store)
+    model = new_model()
+    return lambda: adapter.load_policy(model)
+
+
+def bench_load_filtered_policy(setup):
+    model = new_model()
+    filter = Filter()
+    filter.v1 = ["data1", "data2"]
+    return lambda: setup.adapter.load_filtered_policy(model, filter)
+
+
+def changed_model(size):
+    # one percent of the rules changed
+    changed = max(1, size // 100)
+    return model_with([rule(i) for i in range(changed, size + changed)])
+
+
+def bench_save_policy(setup):
+    model = changed_model(setup.size)
+    return lambda: setup.adapter.save_policy(model)
+
+
+def bench_save_policy_generic(setup):
+    # executemany INSERTs instead of the bulk loader of the dialect
+    adapter = Adapter(setup.engine, create_all_models=False, bulk_loader=BulkLoader())
+    model = changed_model(setup.size)
+    return lambda: adapter.save_policy(model)
+
+
+def bench_save_policy_incremental(setup):
+    adapter = Adapter(setup.engine, create_all_models=False, incremental_save=True)
+    model = changed_model(setup.size)
+    return lambda: adapter.save_policy(model)
+
+
+def bench_iter_policies(setup):
+    return lambda: deque(setup.adapter.iter_policies(), maxlen=0)
+
+
+def bench_import_policies(setup):
+    return lambda: setup.adapter.import_policies(
+        ("p", *rule(i)) for i in range(setup.size, 2 * setup.size)
+    )
+
+
+def bench_add_policies(setup):
+    rules = [rule(i) for i in range(setup.size, setup.size + batch(setup.size))]
+    return lambda: setup.adapter.add_policies("p", "p", rules)
+
+
+def bench_remove_policies(setup):
+    rules = [rule(i) for i in range(batch(setup.size))]
+    return lambda: setup.adapter.remove_policies("p", "p", rules)
+
+
+def bench_update_policies(setup):
+    old_rules = [rule(i) for i in range(batch(setup.size))]
+    new_rules = [[v0, v1, "execute"] for v0, v1, _ in old_rules]
+    return lambda: setup.adapter.update_policies("p", "p", old_rules, new_rules)
+
+
+def bench_remove_filtered_policy(setup):
+    return lambda: setup.adapter.remove_filtered_policy("p", "p", 1, "data7")
+
+
+def calls(size):
+    return min(1000, size)
+
+
+def bench_add_policy(setup):
+    adapter = setup.adapter
+    rules = [rule(i) for i in range(setup.size, setup.size + calls(setup.size))]
+
+    def run():
+        for r in rules:
+            adapter.add_policy("p", "p", r)
+
+    return run
+
+
+def bench_add_policy_buffered(setup):
+    rules = [rule(i) for i in range(setup.size, setup.size + calls(setup.size))]
+    # a single batch, so that the statement count does not depend on thread timing
+    adapter = Adapter(
+        setup.engine,
+        BenchRuleIndexed,
+        create_all_models=False,
+        write_buffer_size=len(rules),
+    )
+
+    def run():
+        for r in rules:
+            adapter.add_policy("p", "p", r)
+        adapter.close()
+
+    return run
+
+
+def bench_remove_policy(setup):
+    adapter = setup.adapter
+    rules = [rule(i) for i in range(calls(setup.size))]
+
+    def run():
+        for r in rules:
+            adapter.remove_policy("p", "p", r)
+
+    return run
+
+
+def bench_update_policy(setup):
+    adapter = setup.adapter
+    rules = [rule(i) for i in range(calls(setup.size))]
+
+    def run():
+        for r in rules:
+            adapter.update_policy("p", "p", r, [r[0], r[1], "execute"])
+
+    return run
+
+
+def bench_construct(setup):
+    # the schema check runs once per file database and process
+    return lambda: [Adapter(setup.engine) for _ in range(100)]
+
+
+def bench_concurrent(setup):
+    # four threads adding rules one by one while four threads load filtered policies
+    adapter = setup.adapter
+
+    def write(thread):
+        for i in range(100):
+            adapter.add_policy("p", "p", ["writer{}".format(thread), str(i), "write"])
+
+    def read(thread):
+        filter = Filter()
+        filter.v1 = ["data{}".format(thread)]
+        for _ in range(10):
+            adapter.load_filtered_policy(new_model(), filter)
+
+    def run():
+        with ThreadPoolExecutor(8) as executor:
+            futures = [executor.submit(write, thread) for thread in range(4)]
+            futures += [executor.submit(read, thread) for thread in range(4)]
+            for future in futures:
+                future.result()
+
+    return run
+
+
+# name: (benchmark, table)
+OPERATIONS = {
+    "load_policy": (bench_load_policy, "plain"),
+    "load_policy_parallel": (bench_load_policy_parallel, "plain"),
+    "load_policy_store": (bench_load_policy_store, "plain"),
+    "load_filtered_policy": (bench_load_filtered_policy, "plain"),
+    "save_policy": (bench_save_policy, "plain"),
+    "save_policy_generic": (bench_save_policy_generic, "plain"),
+    "save_policy_incremental": (bench_save_policy_incremental, "plain"),
+    "iter_policies": (bench_iter_policies, "plain"),
+    "import_policies": (bench_import_policies, "plain"),
+    "save_policy_softdelete": (bench_save_policy, "softdelete"),
+    "add_policies": (bench_add_policies, "plain"),
+    "remove_policies": (bench_remove_policies, "plain"),
+    "update_policies": (bench_update_policies, "plain"),
+    "remove_filtered_policy": (bench_remove_filtered_policy, "plain"),
+    # a thousand single-rule calls on an indexed table, for the per-call overhead
+    "add_policy": (bench_add_policy, "indexed"),
+    "add_policy_buffered": (bench_add_policy_buffered, "indexed"),
+    "remove_policy": (bench_remove_policy, "indexed"),
+    "update_policy": (bench_update_policy, "indexed"),
+    "construct": (bench_construct, "plain"),
+    # file databases only, the threads of in-memory ones do not share the database
+    "concurrent": (bench_concurrent, "plain"),
+    "concurrent_profiled": (bench_concurrent, "profiled"),
+}
+FILE_ONLY = {"concurrent", "concurrent_profiled"}
+
+
+@contextmanager
+def count_statements(engine):
+    counter = [0]
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        counter[0] += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def measure(operation, database, size, memory=True):
+    """Runs operation once for the wall time and statement count, once for the peak memory."""
+    benchmark, table = OPERATIONS[operation]
+
+    setup = Setup(database, size, table)
+    try:
+        run = benchmark(setup)
+        with count_statements(setup.engine) as statements:
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+    finally:
+        setup.close()
+
+    result = {"seconds": round(seconds, 4), "statements": statements[0]}
+    if memory:
+        # tracemalloc slows the run down, so it is measured separately
+        setup = Setup(database, size, table)
+        try:
+            run = benchmark(setup)
+            tracemalloc.start()
+            run()
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            setup.close()
+    return result
+
+
+def regressions(results, baseline, threshold, noise=0.005):
+    """Returns a description of each result that regressed against the baseline.
+
+    Slowdowns of less than noise seconds are ignored, short operations jitter.
+    """
+    found = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result["seconds"] > max(
+            base["seconds"] * (1 + threshold), base["seconds"] + noise
+        ):
+            found.append(
+                "{}: {:.4f}s, baseline {:.4f}s".format(
+                    key, result["seconds"], base["seconds"]
+                )
+            )
+        if result["statements"] > base["statements"]:
+            found.append(
+                "{}: {} statements, baseline {}".format(
+                    key, result["statements"], base["statements"]
+                )
+            )
+        if "peak_bytes" in result and "peak_bytes" in base:
+            if result["peak_bytes"] > base["peak_bytes"] * (1 + threshold):
+                found.append(
+                    "{}: {} bytes peak, baseline {}".format(
+                        key, result["peak_bytes"], base["peak_bytes"]
+                    )
+                )
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument(
+        "--databases", nargs="+", choices=["memory", "file"], default=["memory", "file"]
+    )
+    parser.add_argument(
+        "--operations", nargs="+", choices=list(OPERATIONS), default=list(OPERATIONS)
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the peak memory runs"
+    )
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25, help="allowed relative slowdown"
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(
+        "{:<40} {:>10} {:>11} {:>14}".format(
+            "benchmark", "seconds", "statements", "peak bytes"
+        )
+    )
+    for size in args.sizes:
+        for database in args.databases:
+            for operation in args.operations:
+                if database == "memory" and operation in FILE_ONLY:
+                    continue
+                key = "{}/{}/{}".format(operation, database, size)
+                result = measure(operation, database, size, memory=not args.no_memory)
+                results[key] = result
+                print(
+                    "{:<40} {:>10.4f} {:>11} {:>14}".format(
+                        key,
+                        result["seconds"],
+                        result["statements"],
+                        result.get("peak_bytes", "-"),
+                    )
+                )
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        for regression in found:
+            print("REGRESSION " + regression)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,4 @@
 from .adapter import CasbinRule, Adapter, Base
+from .metrics import AdapterMetrics
+from .policy_store import SharedPolicyStore
+from .async_adapter import AsyncAdapter
@@ -1,10 +1,32 @@
+import functools
+import hashlib
+import json
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import chain, count
 
 import sqlalchemy
 from casbin import persist
-from sqlalchemy import Column, Integer, String, Boolean
-from sqlalchemy import create_engine, or_, not_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, Boolean, MetaData, Table
+from sqlalchemy import and_, create_engine, delete, func, insert, or_, not_
+from sqlalchemy import bindparam, select, tuple_, update
+from sqlalchemy import Index, event
+from sqlalchemy.engine import Connection
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, MultipleResultsFound, NoResultFound
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool, SingletonThreadPool, StaticPool
+
+from . import snapshot
+from .bulk_load import _chunked, bulk_loader_for
+from .metrics import AdapterMetrics
+from .policy_store import SharedPolicyStore
+from .sqlite_profile import apply_sqlite_profile, create_sqlite_engine
+from .write_buffer import WriteBuffer
 
 # declarative base class
 if sqlalchemy.__version__.startswith("1."):
@@ -43,6 +65,56 @@ class CasbinRule(Base):
         return '<CasbinRule {}: "{}">'.format(self.id, str(self))
 
 
+_RULE_ATTRS = ("ptype", "v0", "v1", "v2", "v3", "v4", "v5")
+
+
+def _policy_of(model, ptype):
+    """Returns the policy list of the assertion for ptype, or None if the model has no such assertion."""
+    if not ptype:
+        return None
+    sec = ptype[0]  # derived from persist.load_policy_line function
+    if sec not in model.model.keys() or ptype not in model.model[sec].keys():
+        return None
+    return model.model[sec][ptype].policy
+
+
+def _rule_key(row):
+    """Returns the (ptype, v0, ...) tuple of a row, up to its first None field."""
+    try:
+        end = row.index(None, 1)
+    except ValueError:
+        end = len(row)
+    return tuple(row[:end])
+
+
+def _policy_fields(line):
+    """Parses a policy line like ``p, alice, data1, read``, None for blank lines and comments.
+
+    Commas within brackets or parentheses do not split fields, as in
+    ``persist.load_policy_line`` of casbin.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    depth = 0
+    fields = [""]
+    for c in line:
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c == "," and depth == 0:
+            fields.append("")
+            continue
+        fields[-1] += c
+    return [field.strip() for field in fields]
+
+
+def _rule_hash(key):
+    """Returns the 32 character hex digest identifying a (ptype, v0, ...) rule key."""
+    return hashlib.blake2b(json.dumps(key).encode(), digest_size=16).hexdigest()
+
+
 class Filter:
     ptype = []
     v0 = []
@@ -52,26 +124,122 @@ class Filter:
     v4 = []
     v5 = []
 
+    def partition(self, field, values):
+        """Returns a copy of the filter for each value, matching only that value in field."""
+        filters = []
+        for value in values:
+            filter = Filter()
+            for attr in _RULE_ATTRS:
+                setattr(filter, attr, getattr(self, attr))
+            setattr(filter, field, [value])
+            filters.append(filter)
+        return filters
 
-class Adapter(persist.Adapter, persist.adapters.UpdateAdapter):
-    """the interface for Casbin adapters."""
 
-    def __init__(
-        self,
-        engine,
-        db_class=None,
-        db_class_softdelete_attribute=None,
-        filtered=False,
-        create_all_models=True,
+_change_log_metadata = MetaData()
+
+# id of the adapter -> the session or connection the adapter runs its statements on
+_bound_sessions = ContextVar("casbin_sqlalchemy_adapter_sessions", default={})
+
+
+def _change_log_table(name):
+    """Returns the change log table of the given name, declaring it on first use.
+
+    The id of an entry is the version of the policy after the change.
+    """
+    if name in _change_log_metadata.tables:
+        return _change_log_metadata.tables[name]
+    return Table(
+        name,
+        _change_log_metadata,
+        Column("id", Integer, primary_key=True),
+        Column("op", String(16), nullable=False),
+        *(Column(attr, String(255)) for attr in _RULE_ATTRS),
+    )
+
+
+def _change_version_table(name):
+    """Returns the table of the single counter row allocating change log versions.
+
+    Writers lock the row to allocate versions and hold the lock until they commit,
+    so versions are committed in order.
+    """
+    if name in _change_log_metadata.tables:
+        return _change_log_metadata.tables[name]
+    return Table(
+        name,
+        _change_log_metadata,
+        Column("id", Integer, primary_key=True, autoincrement=False),
+        Column("version", Integer, nullable=False),
+    )
+
+
+# keys of the schemas created, or found to exist, in databases by this process
+_created_schemas = set()
+
+
+def _schema_key(url, tables, indexes=()):
+    """Returns the key of the tables, their indexes and the further indexes in the database at url.
+
+    In-memory SQLite databases are private to an engine, they get None.
+    """
+    if url.get_backend_name() == "sqlite" and (
+        url.database in (None, "", ":memory:") or url.query.get("mode") == "memory"
     ):
-        if isinstance(engine, str):
-            self._engine = create_engine(engine)
-        else:
-            self._engine = engine
+        return None
+    return (
+        url.render_as_string(hide_password=False),
+        tuple(
+            (table.fullname, tuple(sorted(index.name for index in table.indexes)))
+            for table in tables
+        ),
+        tuple(sorted(index.name for index in indexes)),
+    )
+
+
+def _round_robin():
+    """Returns a read engine selector that cycles through the engines."""
+    counter = count()
+    return lambda engines: engines[next(counter) % len(engines)]
+
+
+def _instrumented(method):
+    """Records the calls of an adapter method when metrics are enabled."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._metrics is None:
+            return method(self, *args, **kwargs)
+        with self._metrics.operation(method.__name__):
+            return method(self, *args, **kwargs)
 
+    return wrapper
+
+
+class _RuleStatements:
+    """Builds the statements shared by the synchronous and asynchronous adapters.
+
+    Subclasses provide ``self._engine``, call ``_configure`` and run the statements.
+    """
+
+    def _configure(
+        self,
+        db_class,
+        db_class_softdelete_attribute,
+        filtered,
+        chunk_size,
+        index_rules,
+        unique_rules,
+        db_class_rule_key_attribute=None,
+    ):
         self.softdelete_attribute = None
+        self._rule_key_column = None
 
         if db_class is None:
+            if db_class_rule_key_attribute is not None:
+                msg = "db_class_rule_key_attribute needs a custom db_class with that column, "
+                msg += f"it cannot be used with the default {CasbinRule.__name__!r}."
+                raise ValueError(msg)
             db_class = CasbinRule
         else:
             if db_class_softdelete_attribute is not None and not isinstance(
@@ -83,6 +251,17 @@ class Adapter(persist.Adapter, persist.adapters.UpdateAdapter):
             # Softdelete is only supported when using custom class
             self.softdelete_attribute = db_class_softdelete_attribute
 
+            if db_class_rule_key_attribute is not None:
+                column_type = db_class_rule_key_attribute.type
+                if (
+                    not isinstance(column_type, String)
+                    or (column_type.length or 32) < 32
+                ):
+                    msg = "The type of db_class_rule_key_attribute needs to be a String of at least 32 characters. "
+                    msg += f"An attribute of type {column_type!r} was given."
+                    raise ValueError(msg)
+                self._rule_key_column = db_class_rule_key_attribute.expression.key
+
             for attr in (
                 "id",
                 "ptype",
@@ -95,197 +274,1343 @@ class Adapter(persist.Adapter, persist.adapters.UpdateAdapter):
             ):  # id attr was used by filter
                 if not hasattr(db_class, attr):
                     raise Exception(f"{attr} not found in custom DatabaseClass.")
-            Base.metadata = db_class.metadata
 
         self._db_class = db_class
-        self.session_local = sessionmaker(bind=self._engine)
+        # Core statements address columns by column key, which may differ from the attribute name
+        self._rule_keys = tuple(
+            db_class.__mapper__.columns[attr].key for attr in _RULE_ATTRS
+        )
+
+        self._unique_rules = unique_rules
+        self._rule_indexes = []
+        if self._rule_key_column is not None:
+            # the narrow rule key index replaces the composite one for lookups
+            self._rule_indexes = self._build_rule_indexes(index_rules, unique_rules)
+        elif index_rules or unique_rules:
+            self._rule_indexes = self._build_rule_indexes(True, unique_rules)
 
-        if create_all_models:
-            Base.metadata.create_all(self._engine)
         self._filtered = filtered
+        self._chunk_size = chunk_size
+        self._statements = {}
+
+    @property
+    def _dialect(self):
+        return self._engine.dialect
+
+    @contextmanager
+    def using(self, session):
+        """Runs the operations of the adapter in the block on the caller's session or connection.
+
+        The statements join the transaction of session, which is neither committed
+        nor rolled back by the adapter, so that policy changes are atomic with the
+        caller's own writes. The binding is local to the current thread or task.
+        """
+        bound = _bound_sessions.get()
+        token = _bound_sessions.set({**bound, id(self): session})
+        try:
+            yield session
+        finally:
+            _bound_sessions.reset(token)
+
+    def _bound_session(self):
+        """Returns the session bound with using, or None."""
+        return _bound_sessions.get().get(id(self))
+
+    def _build_rule_indexes(self, composite, unique):
+        """Returns a composite (ptype, v0, ..., v5) index and optionally a unique index of the rule table.
+
+        With a rule key column, that column is indexed instead, unique if requested.
+        Otherwise NULL fields never compare equal in a unique index, so the unique
+        index covers ``COALESCE(v*, '')`` expressions instead of the bare columns, or
+        on MySQL, which limits the key length, an MD5 hash of them.
+        With soft delete, the unique index only applies to rows that are not deleted.
+
+        The indexes are detached from the table, which is shared by all adapters of
+        the model, so that only this adapter creates them. Indexes the model declares
+        itself are left out.
+        """
+        table = self._db_class.__table__
+        names = {index.name for index in table.indexes}
+        columns = [table.c[key] for key in self._rule_keys]
+        indexes = []
+
+        name = "ix_{}_rule".format(table.name)
+        if composite and name not in names:
+            # MySQL limits the key length, index a prefix of each column there
+            indexes.append(
+                Index(name, *columns, mysql_length={c.name: 64 for c in columns})
+            )
+
+        where = None
+        if self.softdelete_attribute is not None:
+            where = not_(table.c[self.softdelete_attribute.expression.key])
+
+        if self._rule_key_column is not None:
+            name = "ix_{}_rule_key".format(table.name)
+            if name not in names:
+                indexes.append(
+                    Index(
+                        name,
+                        table.c[self._rule_key_column],
+                        unique=unique,
+                        sqlite_where=where if unique else None,
+                        postgresql_where=where if unique else None,
+                    )
+                )
+        else:
+            name = "uq_{}_rule".format(table.name)
+            fields = [func.coalesce(c, "") for c in columns]
+            if self._dialect.name in ("mysql", "mariadb"):
+                # the fields exceed MySQL's key length, index a hash of their hashes,
+                # NULL for deleted rows as MySQL has no partial indexes
+                fields = [func.md5(func.concat(*(func.md5(f) for f in fields)))]
+                if where is not None:
+                    deleted = table.c[self.softdelete_attribute.expression.key]
+                    fields = [func.if_(deleted, None, fields[0])]
+            if unique and name not in names:
+                indexes.append(
+                    Index(
+                        name,
+                        *fields,
+                        unique=True,
+                        sqlite_where=where,
+                        postgresql_where=where,
+                    )
+                )
+
+        for index in indexes:
+            # Index attaches itself to the table of its columns, it keeps that table for CREATE INDEX
+            table.indexes.discard(index)
+        return indexes
+
+    def is_filtered(self):
+        return self._filtered
+
+    def _rule_select(self):
+        """Select the plain (ptype, v0, ..., v5) columns, bypassing the ORM identity map."""
+        return select(*(getattr(self._db_class, attr) for attr in _RULE_ATTRS))
+
+    def _id_rule_select(self):
+        """Select the id followed by the plain (ptype, v0, ..., v5) columns."""
+        return select(self._db_class.id, *self._rule_select().selected_columns)
+
+    @staticmethod
+    def _load_policy_rows(rows, model):
+        """Appends (ptype, v0, ..., v5) rows straight to the model's policy lists.
+
+        This is equivalent to ``persist.load_policy_line(str(CasbinRule), model)``
+        without formatting every row to a string and parsing it back.
+        """
+        policies = {}
+        for row in rows:
+            ptype = row[0]
+            try:
+                policy = policies[ptype]
+            except KeyError:
+                policy = policies[ptype] = _policy_of(model, ptype)
+            if policy is None:
+                continue
+            try:
+                end = row.index(None, 1)
+            except ValueError:
+                end = len(row)
+            policy.append(list(row[1:end]))
+
+    def filter_query(self, querydb, filter):
+        for attr in _RULE_ATTRS:
+            if len(getattr(filter, attr)) > 0:
+                querydb = querydb.filter(
+                    getattr(self._db_class, attr).in_(getattr(filter, attr))
+                )
+        return querydb.order_by(self._db_class.id)
+
+    def _max_bind_params(self):
+        """Returns how many bound parameters a single statement may use on this database."""
+        dialect = self._dialect
+        if dialect.name == "sqlite":
+            version = dialect.server_version_info
+            return 32766 if version is not None and version >= (3, 32, 0) else 999
+        if dialect.name == "mssql":
+            return 2000
+        return 32767
+
+    def _bind_chunk_size(self, params_per_item):
+        """Returns how many items of params_per_item parameters fit in one statement."""
+        return max(1, min(self._chunk_size, self._max_bind_params() // params_per_item))
+
+    def _rule_row(self, ptype, rule):
+        """Returns the column values of a rule, padded with None up to v5, and its rule key if enabled."""
+        keys = self._rule_keys
+        row = {keys[0]: ptype}
+        for i in range(1, len(keys)):
+            row[keys[i]] = rule[i - 1] if i <= len(rule) else None
+        if self._rule_key_column is not None:
+            row[self._rule_key_column] = _rule_hash((ptype, *rule))
+        return row
+
+    def _insert_statement(self):
+        """Returns an INSERT that skips rules already present when ``unique_rules`` is enabled.
+
+        Only SQLite, PostgreSQL and MySQL/MariaDB can ignore conflicting rows, other
+        databases raise an IntegrityError on duplicates.
+        """
+        table = self._db_class.__table__
+        if not self._unique_rules:
+            return insert(table)
+        dialect = self._dialect.name
+        if dialect == "sqlite":
+            return sqlite.insert(table).on_conflict_do_nothing()
+        if dialect == "postgresql":
+            return postgresql.insert(table).on_conflict_do_nothing()
+        if dialect in ("mysql", "mariadb"):
+            return insert(table).prefix_with("IGNORE")
+        return insert(table)
+
+    def _cached_statement(self, key, build, *args):
+        """Returns the statement cached under key, building it with build(*args) on first use.
+
+        The cached statements take their values as bound parameters, so the statement
+        is constructed once and its compiled form is reused by SQLAlchemy.
+        """
+        stmt = self._statements.get(key)
+        if stmt is None:
+            stmt = self._statements[key] = build(*args)
+        return stmt
+
+    def _key_clause(self):
+        """Returns a WHERE clause comparing the rule key column to the b_key parameter."""
+        return self._db_class.__table__.c[self._rule_key_column] == bindparam("b_key")
+
+    def _params_clause(self, indexes):
+        """Returns a WHERE clause comparing ptype and the v<i> fields to the b_ptype and b_v<i> parameters."""
+        table = self._db_class.__table__
+        keys = self._rule_keys
+        clauses = [table.c[keys[0]] == bindparam("b_ptype")]
+        for i in indexes:
+            clauses.append(table.c[keys[i + 1]] == bindparam("b_v{}".format(i)))
+        return and_(*clauses)
+
+    @staticmethod
+    def _rule_params(ptype, rule):
+        """Returns the parameters of a clause built with _params_clause for a rule."""
+        params = {"b_ptype": ptype}
+        for i, v in enumerate(rule):
+            params["b_v{}".format(i)] = v
+        return params
+
+    def _remove_rule_statement(self, ptype, rule):
+        """Returns the cached statement removing the live rows matching a rule and its parameters.
+
+        With a rule key column, the rule is looked up by its key and has to match exactly.
+        """
+        if self._rule_key_column is not None:
+            stmt = self._cached_statement(
+                ("remove_key",),
+                lambda: self._remove_statement(self._key_clause()),
+            )
+            return stmt, {"b_key": _rule_hash((ptype, *rule))}
+        stmt = self._cached_statement(
+            ("remove", len(rule)),
+            lambda: self._remove_statement(self._params_clause(range(len(rule)))),
+        )
+        return stmt, self._rule_params(ptype, rule)
+
+    def _remove_filtered_statement(self, ptype, field_index, field_values):
+        """Returns the cached statement of remove_filtered_policy and its parameters.
+
+        Returns None for an invalid filter. Empty field values match anything.
+        """
+        if not (0 <= field_index <= 5):
+            return None
+        if not (1 <= field_index + len(field_values) <= 6):
+            return None
+        params = {"b_ptype": ptype}
+        indexes = []
+        for i, v in enumerate(field_values, field_index):
+            if v != "":
+                params["b_v{}".format(i)] = v
+                indexes.append(i)
+        indexes = tuple(indexes)
+        stmt = self._cached_statement(
+            ("remove_filtered", indexes),
+            lambda: self._remove_statement(self._params_clause(indexes)),
+        )
+        return stmt, params
+
+    def _update_rule_statement(self, ptype, old_rule, new_rule):
+        """Returns the cached UPDATE overwriting the live rows matching old_rule and its parameters.
+
+        Fields beyond the longer of both rules are left alone. With a rule key column,
+        old_rule is looked up by its key and all fields and the key are overwritten.
+        """
+        if self._rule_key_column is not None:
+            width = len(self._rule_keys) - 1
+            where = self._key_clause
+            params = {"b_key": _rule_hash((ptype, *old_rule))}
+        else:
+            width = max(len(old_rule), len(new_rule))
+            where = lambda: self._params_clause(range(len(old_rule)))  # noqa: E731
+            params = self._rule_params(ptype, old_rule)
+
+        def build():
+            table = self._db_class.__table__
+            values = {
+                self._rule_keys[i + 1]: bindparam("n_v{}".format(i))
+                for i in range(width)
+            }
+            if self._rule_key_column is not None:
+                values[self._rule_key_column] = bindparam("n_key")
+            stmt = update(table).where(where())
+            return self._softdelete_query(stmt.values(values))
+
+        stmt = self._cached_statement(("update", len(old_rule), width), build)
+        for i in range(width):
+            params["n_v{}".format(i)] = new_rule[i] if i < len(new_rule) else None
+        if self._rule_key_column is not None:
+            params["n_key"] = _rule_hash((ptype, *new_rule))
+        return stmt, params
+
+    def _model_rows(self, model):
+        """Yields the rows of every rule in the model."""
+        for sec in ["p", "g"]:
+            if sec not in model.model.keys():
+                continue
+            for ptype, ast in model.model[sec].items():
+                for rule in ast.policy:
+                    yield self._rule_row(ptype, rule)
+
+    @staticmethod
+    def _model_rules(model):
+        """Returns the rules of the model keyed by their (ptype, *rule) tuple."""
+        model_rules = {}
+        for sec in ["p", "g"]:
+            if sec not in model.model.keys():
+                continue
+            for ptype, ast in model.model[sec].items():
+                for rule in ast.policy:
+                    model_rules[(ptype, *rule)] = rule
+        return model_rules
+
+    def _policy_diff(self, rows, model):
+        """Diffs the live (id, ptype, v0, ..., v5) rows against the model.
+
+        Returns the rules missing in the database, keyed by (ptype, *rule), the
+        ids of the rows whose rule is not part of the model anymore, keyed likewise,
+        and the ids of the surplus rows of rules stored more than once.
+        """
+        live_rules = {}
+        for row in rows:
+            live_rules.setdefault(_rule_key(row[1:]), []).append(row[0])
+
+        model_rules = self._model_rules(model)
+        added = {
+            key: rule for key, rule in model_rules.items() if key not in live_rules
+        }
+        removed = {}
+        duplicates = []
+        for key, ids in live_rules.items():
+            if key not in model_rules:
+                removed[key] = ids
+            elif len(ids) > 1:
+                duplicates.extend(ids[1:])
+        return added, removed, duplicates
+
+    def _change_rows(self, op, keys):
+        """Yields the change log rows recording op for the (ptype, *rule) keys."""
+        for key in keys:
+            row = {"op": op}
+            for i, attr in enumerate(_RULE_ATTRS):
+                row[attr] = key[i] if i < len(key) else None
+            yield row
+
+    def _remove_ids_statements(self, ids):
+        """Yields the statements removing the rows of the given ids, in chunks."""
+        for chunk in _chunked(ids, self._bind_chunk_size(1)):
+            yield self._remove_statement(self._db_class.__table__.c.id.in_(chunk))
+
+    def _remove_statement(self, *clauses):
+        """Returns a DELETE, or an UPDATE setting the deletion flag, of the live rows matching clauses."""
+        table = self._db_class.__table__
+        if self.softdelete_attribute is None:
+            stmt = delete(table)
+        else:
+            stmt = update(table).values({self.softdelete_attribute: True})
+        return self._softdelete_query(stmt.where(*clauses))
+
+    def _supports_returning(self):
+        """Whether the database returns the rows removed by _remove_statement."""
+        dialect = self._dialect
+        if sqlalchemy.__version__.startswith("1."):
+            # SQLAlchemy 1.4 only knows full_returning, which PostgreSQL sets
+            return getattr(dialect, "full_returning", False)
+        if self.softdelete_attribute is None:
+            return dialect.delete_returning
+        return dialect.update_returning
+
+    def _remove_returning_statement(self, clause):
+        """Returns the removal of the live rows matching clause, returning their (ptype, v0, ..., v5) columns.
+
+        Returns None where the database cannot return the removed rows.
+        """
+        if not self._supports_returning():
+            return None
+        columns = self._rule_select().selected_columns
+        return self._remove_statement(clause).returning(*columns)
+
+    def _locked_rule_ids_query(self, clause):
+        """Selects (id, ptype, v0, ..., v5) of the live rows matching clause, locked until the transaction ends."""
+        return self._softdelete_query(
+            self._id_rule_select().where(clause)
+        ).with_for_update()
+
+    def _filtered_clause(self, ptype, field_index, field_values):
+        """Returns the WHERE clause of remove_filtered_policy, or None for an invalid filter."""
+        if not (0 <= field_index <= 5):
+            return None
+        if not (1 <= field_index + len(field_values) <= 6):
+            return None
+        clauses = [self._db_class.ptype == ptype]
+        for i, v in enumerate(field_values):
+            if v != "":
+                v_value = getattr(self._db_class, "v{}".format(field_index + i))
+                clauses.append(v_value == v)
+        return and_(*clauses)
+
+    def _supports_row_values(self):
+        """Whether the database understands (a, b) IN ((?, ?), ...) comparisons."""
+        dialect = self._dialect
+        if dialect.name == "sqlite":
+            version = dialect.server_version_info
+            return version is not None and version >= (3, 15, 0)
+        return dialect.name in ("postgresql", "mysql", "mariadb")
+
+    def _rules_clauses(self, ptype, rules):
+        """Yields WHERE clauses matching exactly the given rules of ptype, in chunks.
+
+        Fields beyond the length of a rule must be NULL. Each clause stays below the
+        bound parameter limit of the database. Row values are compared with
+        ``(ptype, v0, ...) IN (...)`` where supported and with ORed conjunctions otherwise.
+        """
+        if self._rule_key_column is not None:
+            column = self._db_class.__table__.c[self._rule_key_column]
+            hashes = (_rule_hash((ptype, *rule)) for rule in rules)
+            for chunk in _chunked(hashes, self._bind_chunk_size(1)):
+                yield column.in_(chunk)
+            return
+
+        by_length = {}
+        for rule in rules:
+            by_length.setdefault(len(rule), []).append((ptype, *rule))
+
+        row_values = self._supports_row_values()
+        columns = [getattr(self._db_class, attr) for attr in _RULE_ATTRS]
+        for length, keys in by_length.items():
+            matched, unset = columns[: length + 1], columns[length + 1 :]
+            for chunk in _chunked(keys, self._bind_chunk_size(length + 1)):
+                if row_values:
+                    clause = tuple_(*matched).in_(chunk)
+                else:
+                    clause = or_(
+                        *(
+                            and_(*(c == v for c, v in zip(matched, key)))
+                            for key in chunk
+                        )
+                    )
+                yield and_(clause, *(c.is_(None) for c in unset))
+
+    def _rule_ids_queries(self, ptype, rules):
+        """Yields the queries selecting (id, ptype, v0, ..., v5) of the live rows matching rules."""
+        for clause in self._rules_clauses(ptype, rules):
+            yield self._softdelete_query(self._id_rule_select().where(clause))
+
+    def _update_by_id(self, ptype, old_rules, new_rules, ids):
+        """Returns the executemany UPDATE by id, its parameters and the old rules not found.
+
+        ids maps (ptype, *rule) keys to the ids of the rows storing that rule.
+        """
+        table = self._db_class.__table__
+        id_key = self._db_class.__mapper__.columns["id"].key
+        # the v* columns, and the rule key if enabled
+        columns = [
+            key for key in self._rule_row(ptype, []) if key != self._rule_keys[0]
+        ]
+        not_found = []
+        params = []
+        for old_rule, new_rule in zip(old_rules, new_rules):
+            old_ids = ids.get((ptype, *old_rule))
+            if not old_ids:
+                not_found.append(old_rule)
+                continue
+            row = self._rule_row(ptype, new_rule)
+            for old_id in old_ids:
+                param = {"b_" + key: row[key] for key in columns}
+                param["b_id"] = old_id
+                params.append(param)
+
+        stmt = (
+            update(table)
+            .where(table.c[id_key] == bindparam("b_id"))
+            .values({key: bindparam("b_" + key) for key in columns})
+        )
+        return stmt, params, not_found
+
+    @staticmethod
+    def _check_one_updated(rowcount):
+        """Raises like Result.scalar_one unless update_policy changed exactly one row.
+
+        The exception rolls back the transaction of the update.
+        """
+        if rowcount == 0:
+            raise NoResultFound("No row was found when one was required")
+        if rowcount > 1:
+            raise MultipleResultsFound(
+                "Multiple rows were found when exactly one was required"
+            )
+
+    def _softdelete_query(self, query):
+        query_softdelete = query
+        if self.softdelete_attribute is not None:
+            query_softdelete = query_softdelete.where(not_(self.softdelete_attribute))
+        return query_softdelete
+
+
+class Adapter(persist.Adapter, persist.adapters.UpdateAdapter, _RuleStatements):
+    """the interface for Casbin adapters."""
+
+    def __init__(
+        self,
+        engine,
+        db_class=None,
+        db_class_softdelete_attribute=None,
+        filtered=False,
+        create_all_models=True,
+        chunk_size=1000,
+        index_rules=False,
+        unique_rules=False,
+        change_log=False,
+        snapshot_path=None,
+        metrics=None,
+        load_workers=1,
+        write_buffer_size=0,
+        write_buffer_interval=1.0,
+        on_flush_error=None,
+        db_class_rule_key_attribute=None,
+        bulk_loader=None,
+        incremental_save=False,
+        read_engines=None,
+        read_engine_selector=None,
+        read_your_writes=0.0,
+        sqlite_profile=False,
+        policy_store=None,
+    ):
+        # True, or a dict of pragmas overriding those of the profile
+        pragmas = sqlite_profile if isinstance(sqlite_profile, dict) else {}
+        if isinstance(engine, str):
+            if sqlite_profile:
+                self._engine = create_sqlite_engine(engine, **pragmas)
+            else:
+                self._engine = create_engine(engine)
+        else:
+            self._engine = engine
+            if sqlite_profile:
+                apply_sqlite_profile(engine, **pragmas)
+
+        self._read_engines = [
+            create_engine(e) if isinstance(e, str) else e for e in read_engines or ()
+        ]
+        self._read_engine_selector = read_engine_selector or _round_robin()
+        self._read_your_writes = read_your_writes
+        self._last_write = None
+
+        if metrics is True:
+            metrics = AdapterMetrics()
+        self._metrics = metrics or None
+        if self._metrics is not None:
+            for e in (self._engine, *self._read_engines):
+                self._metrics.attach(e)
+
+        self._configure(
+            db_class,
+            db_class_softdelete_attribute,
+            filtered,
+            chunk_size,
+            index_rules,
+            unique_rules,
+            db_class_rule_key_attribute,
+        )
+        self.session_local = sessionmaker(bind=self._engine)
+
+        self._change_log = None
+        if change_log:
+            name = "{}_change".format(self._db_class.__table__.name)
+            self._change_log = _change_log_table(name)
+            self._change_version = _change_version_table(name + "_version")
+
+        self._snapshot_path = snapshot_path
+        if isinstance(policy_store, str):
+            policy_store = SharedPolicyStore(policy_store)
+        if policy_store is not None and snapshot_path is not None:
+            raise ValueError("Pass either snapshot_path or policy_store, not both.")
+        self._policy_store = policy_store
+        self._policy_store_version = None
+        # whether this adapter wrote since it last published to the store
+        self._policy_store_stale = False
+        # caller sessions that invalidate the cached policy when they commit
+        self._listened = weakref.WeakSet()
+        self._load_workers = load_workers
+        self._bulk_loader = bulk_loader or bulk_loader_for(self._dialect)
+        self._incremental_save = incremental_save
+
+        self._write_buffer = None
+        if write_buffer_size > 0:
+            self._write_buffer = WriteBuffer(
+                self._write_buffered,
+                write_buffer_size,
+                write_buffer_interval,
+                on_flush_error,
+                background=not self._shares_connections(),
+            )
+
+        # checked once per database and process, adapters created afterwards skip the checks
+        if create_all_models and self._schema_key() not in _created_schemas:
+            self.create_table()
+
+    def _schema_key(self):
+        tables = list(self._db_class.metadata.sorted_tables)
+        if self._change_log is not None:
+            tables += [self._change_log, self._change_version]
+        return _schema_key(self._engine.url, tables, self._rule_indexes)
+
+    def create_table(self):
+        """Creates the tables of the models and their indexes that are missing in the database."""
+        self._db_class.metadata.create_all(self._engine)
+        for index in self._rule_indexes:
+            index.create(self._engine, checkfirst=True)
+        if self._change_log is not None:
+            self._change_log.create(self._engine, checkfirst=True)
+            self._change_version.create(self._engine, checkfirst=True)
+            try:
+                with self._engine.begin() as conn:
+                    self._seed_change_version(conn, 0)
+            except IntegrityError:
+                pass  # seeded by another process meanwhile
+        key = self._schema_key()
+        if key is not None:
+            _created_schemas.add(key)
+
+    @contextmanager
+    def _session_scope(self, engine=None):
+        """Provide a transactional scope around a series of operations.
+
+        Reads pass the engine to run on, see _read_engine. Everything else runs on
+        the primary engine and counts as a write for ``read_your_writes``.
+        """
+        if self._write_buffer is not None:
+            # every other operation sees the buffered writes
+            self._write_buffer.flush()
+        session = self._bound_session()
+        if session is not None:
+            # join the transaction of the caller, who commits it
+            yield session
+            if engine is None and self._caches_policy():
+                self._invalidate_cached_policy()
+                if isinstance(session, Session) and session not in self._listened:
+                    # a snapshot taken before the caller commits misses this write
+                    self._listened.add(session)
+                    event.listen(session, "after_commit", self._after_caller_commit)
+            return
+        with self._transaction(engine) as session:
+            yield session
 
     @contextmanager
-    def _session_scope(self):
-        """Provide a transactional scope around a series of operations."""
-        session = self.session_local()
+    def _transaction(self, engine=None):
+        """Provide a transaction on a new session, committed when the block succeeds."""
+        session = self.session_local(bind=engine or self._engine)
+        start = time.perf_counter()
+        committed = False
         try:
             yield session
             session.commit()
+            committed = True
+            if engine is None:
+                self._last_write = time.monotonic()
+                self._invalidate_cached_policy()
         except Exception as e:
             session.rollback()
             raise e
         finally:
             session.close()
+            if self._metrics is not None:
+                self._metrics.transaction(time.perf_counter() - start, committed)
 
+    def _read_engine(self):
+        """Returns the engine to load from.
+
+        That is a read engine picked by the selector, unless there is none or the
+        adapter wrote within the last ``read_your_writes`` seconds.
+        """
+        if not self._read_engines:
+            return self._engine
+        if self._write_buffer is not None:
+            # buffered writes count from when they are written
+            self._write_buffer.flush()
+        if (
+            self._last_write is not None
+            and time.monotonic() - self._last_write < self._read_your_writes
+        ):
+            return self._engine
+        return self._read_engine_selector(self._read_engines)
+
+    @property
+    def metrics(self):
+        """The AdapterMetrics of the adapter, None unless metrics are enabled."""
+        return self._metrics
+
+    def stats(self):
+        """Returns a snapshot of the recorded metrics, see AdapterMetrics.stats."""
+        if self._metrics is None:
+            raise ValueError("Metrics are not enabled, pass metrics=True.")
+        return self._metrics.stats()
+
+    @_instrumented
     def load_policy(self, model):
         """loads all policy rules from the storage."""
-        with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            lines = query.all()
-            for line in lines:
-                persist.load_policy_line(str(line), model)
+        if self._policy_store is not None:
+            return self._load_policy_store(model)
+        engine = self._read_engine()
+        if self._snapshot_path is not None:
+            return self._load_policy_snapshot(model, engine)
+        if self._load_workers > 1:
+            return self._load_policy_parallel(model, engine)
+        with self._session_scope(engine) as session:
+            query = self._softdelete_query(self._rule_select())
+            self._load_policy_rows(self._stream(session, query), model)
+
+    def _load_policy_parallel(self, model, engine):
+        """Loads the policy by id ranges fetched concurrently, merged into the model in id order.
+
+        Every range is read in a transaction of its own, so rules changed while
+        loading may be seen in some ranges and not in others.
+        """
+        id_column = self._db_class.id
+        with self._session_scope(engine) as session:
+            query = select(func.min(id_column), func.max(id_column))
+            low, high = session.execute(self._softdelete_query(query)).one()
+        if low is None:
+            return
 
-    def is_filtered(self):
-        return self._filtered
+        # more ranges than threads, so that gaps in the ids do not leave threads idle
+        partitions = min(self._load_workers * 4, high - low + 1)
+        step = -(-(high - low + 1) // partitions)
+        ranges = [(start, start + step) for start in range(low, high + 1, step)]
+
+        def fetch(id_range):
+            with self._session_scope(engine) as session:
+                query = self._rule_select().where(
+                    id_column >= id_range[0], id_column < id_range[1]
+                )
+                query = self._softdelete_query(query).order_by(id_column)
+                return list(self._stream(session, query))
+
+        for rules in self._map_parallel(fetch, ranges, self._load_workers, engine):
+            self._load_policy_rows(rules, model)
 
+    def _fingerprint(self, session):
+        """Returns a cheap fingerprint of the stored rules.
+
+        This is the version of the change log when it is enabled, and the number of
+        live rows and their largest id otherwise. The latter does not change when
+        another process updates a rule in place, or removes a rule and adds one that
+        reuses its row id; writes of this adapter remove the snapshot instead.
+        """
+        if self._change_log is not None:
+            table = self._change_log
+            return ("version", session.execute(select(func.max(table.c.id))).scalar())
+        query = select(func.count(), func.max(self._db_class.id))
+        count, max_id = session.execute(self._softdelete_query(query)).one()
+        return ("rows", count, max_id)
+
+    def _load_policy_snapshot(self, model, engine):
+        """Loads the policy from the snapshot file if the stored rules did not change.
+
+        Otherwise loads it from the database and writes a new snapshot.
+        """
+        with self._session_scope(engine) as session:
+            fingerprint = self._fingerprint(session)
+            rules = snapshot.read_snapshot(self._snapshot_path, fingerprint)
+            if rules is None:
+                query = self._softdelete_query(self._rule_select())
+                rules = [_rule_key(row) for row in self._stream(session, query)]
+                snapshot.write_snapshot(self._snapshot_path, fingerprint, rules)
+        self._load_policy_rows(rules, model)
+
+    def _load_policy_store(self, model):
+        """Loads the current version of the shared policy store.
+
+        Publishes a new version first if there is none, or if this adapter wrote since
+        it last published, so that its own writes are not lost.
+        """
+        if self._policy_store_stale:
+            with self._policy_store.lock():
+                loaded = self._publish_policy()
+        else:
+            loaded = self._policy_store.read()
+        if loaded is None:
+            with self._policy_store.lock():
+                # another process may have published while this one waited for the lock
+                loaded = self._policy_store.read()
+                if loaded is None:
+                    loaded = self._publish_policy()
+        self._policy_store_version, rules = loaded
+        self._load_policy_rows(rules, model)
+
+    def _publish_policy(self):
+        self._policy_store_stale = False
+        # from the primary, a replica may lag behind the writes to publish
+        with self._session_scope(self._engine) as session:
+            query = self._softdelete_query(self._rule_select())
+            rules = [_rule_key(row) for row in self._stream(session, query)]
+        return self._policy_store.publish(rules), rules
+
+    @property
+    def policy_store(self):
+        """The SharedPolicyStore of the adapter, None unless one is configured."""
+        return self._policy_store
+
+    @_instrumented
+    def publish_policy(self):
+        """Loads the rules from the database and publishes them as a new version of the policy store.
+
+        Returns the new version. Processes sharing the store pick it up with their
+        next ``load_policy``.
+        """
+        if self._policy_store is None:
+            raise ValueError("No policy store is configured, pass policy_store.")
+        with self._policy_store.lock():
+            version, _ = self._publish_policy()
+        return version
+
+    def policy_store_changed(self):
+        """Whether a version other than the one last loaded by this adapter was published."""
+        if self._policy_store is None:
+            raise ValueError("No policy store is configured, pass policy_store.")
+        return self._policy_store.version() != self._policy_store_version
+
+    def _caches_policy(self):
+        """Whether the adapter keeps a snapshot or a policy store to invalidate on writes."""
+        return self._snapshot_path is not None or self._policy_store is not None
+
+    def _after_caller_commit(self, session):
+        self._invalidate_cached_policy()
+
+    def _invalidate_cached_policy(self):
+        """Removes the snapshot file and marks the policy store stale after a write through the adapter.
+
+        The fingerprint may not change on a write, e.g. when a removed rule's row id
+        is reused by an added rule.
+        """
+        self._policy_store_stale = True
+        if self._snapshot_path is not None:
+            try:
+                os.remove(self._snapshot_path)
+            except FileNotFoundError:
+                pass
+
+    @_instrumented
     def load_filtered_policy(self, model, filter) -> None:
         """loads all policy rules from the storage."""
-        with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            filters = self.filter_query(query, filter)
-            filters = filters.all()
-
-            for line in filters:
-                persist.load_policy_line(str(line), model)
+        with self._session_scope(self._read_engine()) as session:
+            query = self._softdelete_query(self._rule_select())
+            query = self.filter_query(query, filter)
+            self._load_policy_rows(self._stream(session, query), model)
             self._filtered = True
 
-    def filter_query(self, querydb, filter):
-        for attr in ("ptype", "v0", "v1", "v2", "v3", "v4", "v5"):
-            if len(getattr(filter, attr)) > 0:
-                querydb = querydb.filter(
-                    getattr(self._db_class, attr).in_(getattr(filter, attr))
-                )
-        return querydb.order_by(self._db_class.id)
+    @_instrumented
+    def load_filtered_policies(self, model_filters, max_workers=None):
+        """Loads the policy rules matching each filter into its model, running the queries concurrently.
+
+        model_filters is an iterable of (model, filter) pairs, e.g. one per tenant.
+        Each query runs in a worker thread on its own pooled connection, at most
+        max_workers at once, which defaults to the size of the connection pool.
+        The models are filled in the order of model_filters. As with
+        load_filtered_policy, role links are not rebuilt.
+        """
+        model_filters = list(model_filters)
+        # one engine for all filters, replicas may lag behind each other
+        engine = self._read_engine()
+
+        def fetch(filter):
+            with self._session_scope(engine) as session:
+                query = self._softdelete_query(self._rule_select())
+                query = self.filter_query(query, filter)
+                return [_rule_key(row) for row in self._stream(session, query)]
+
+        filters = (filter for _, filter in model_filters)
+        for (model, _), rules in zip(
+            model_filters, self._map_parallel(fetch, filters, max_workers, engine)
+        ):
+            self._load_policy_rows(rules, model)
+        self._filtered = True
+
+    def iter_policies(self, filter=None):
+        """Yields the stored rules as (ptype, v0, ...) tuples, optionally only those matching filter.
+
+        The rows are fetched in chunks of ``chunk_size`` within one transaction, which
+        stays open until the generator is exhausted or closed. The tuples can be
+        written with ``csv.writer`` and read back with import_policies.
+        """
+        with self._session_scope(self._read_engine()) as session:
+            query = self._softdelete_query(self._rule_select())
+            if filter is None:
+                query = query.order_by(self._db_class.id)
+            else:
+                query = self.filter_query(query, filter)
+            for row in self._stream(session, query):
+                yield _rule_key(row)
+
+    def _shares_connections(self, engine=None):
+        """Whether the pool of engine, the primary by default, cannot serve other threads concurrently.
+
+        In-memory SQLite databases are private to a connection, and pools sharing
+        one connection cannot serve threads concurrently.
+        """
+        pool = (engine or self._engine).pool
+        return isinstance(pool, (SingletonThreadPool, StaticPool))
+
+    def _parallel_workers(self, max_workers, engine):
+        """Returns how many threads may query engine at once, None for the executor default."""
+        if self._shares_connections(engine) or self._bound_session() is not None:
+            return 1
+        pool = engine.pool
+        if max_workers is None and isinstance(pool, QueuePool):
+            return pool.size()
+        return max_workers
+
+    def _map_parallel(self, fn, items, max_workers, engine):
+        """Yields fn(item) for the items in order, computed by a bounded thread pool on engine."""
+        workers = self._parallel_workers(max_workers, engine)
+        if workers == 1:
+            yield from map(fn, items)
+            return
+        if self._metrics is not None:
+            fn = self._metrics.propagate(fn)
+        with ThreadPoolExecutor(workers) as executor:
+            yield from executor.map(fn, items)
+
+    def _stream(self, session, query):
+        """Execute the query, fetching rows in chunks of ``chunk_size``."""
+        result = session.execute(query.execution_options(yield_per=self._chunk_size))
+        if self._metrics is None:
+            return result
+        return self._metrics.fetched(result)
 
     def _save_policy_line(self, ptype, rule, session=None):
-        line = self._db_class(ptype=ptype)
-        for i, v in enumerate(rule):
-            setattr(line, "v{}".format(i), v)
         if session:
-            session.add(line)
+            self._bulk_insert(session, [self._rule_row(ptype, rule)])
         else:
             with self._session_scope() as session:
-                session.add(line)
+                self._bulk_insert(session, [self._rule_row(ptype, rule)])
+
+    def _bulk_insert(self, session, rows):
+        """Inserts rule rows using one executemany INSERT per chunk of ``chunk_size`` rows."""
+        stmt = self._cached_statement(("insert",), self._insert_statement)
+        for chunk in _chunked(rows, self._chunk_size):
+            session.execute(stmt, chunk)
+
+    def _bulk_load(self, session, rows):
+        """Inserts many rule rows, e.g. all the rules of a model, with the bulk loader."""
+        connection = (
+            session if isinstance(session, Connection) else session.connection()
+        )
+        stmt = self._cached_statement(("insert",), self._insert_statement)
+        self._bulk_loader.load(connection, stmt, rows, self._chunk_size)
+
+    def _write_buffered(self, operations):
+        """Writes a batch of buffered operations, keyed by (ptype, *rule), in one transaction."""
+        removed = [key for key, op in operations.items() if op != "add"]
+        added = [key for key, op in operations.items() if op != "remove"]
+        with self._transaction() as session:
+            # one executemany statement per rule length
+            removals = {}
+            for key in removed:
+                stmt, params = self._remove_rule_statement(key[0], key[1:])
+                removals.setdefault(stmt, []).append(params)
+            for stmt, params in removals.items():
+                for chunk in _chunked(params, self._chunk_size):
+                    session.execute(stmt, chunk)
+            self._bulk_insert(
+                session, (self._rule_row(key[0], key[1:]) for key in added)
+            )
+            self._log_changes(session, "remove", removed)
+            self._log_changes(session, "add", added)
+
+    @_instrumented
+    def flush(self):
+        """Writes the buffered mutations.
+
+        Raises FlushError when writing them, or a batch written in the background
+        before, failed. Does nothing unless write buffering is enabled.
+        """
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+
+    def close(self):
+        """Writes the buffered mutations and stops the background thread of the write buffer."""
+        if self._write_buffer is not None:
+            self._write_buffer.close()
+
+    @_instrumented
+    def backfill_rule_keys(self):
+        """Stores the rule key of the rows that have none, e.g. after the column was added.
+
+        Rows are updated in transactions of ``chunk_size`` rows. Returns the number of
+        updated rows.
+        """
+        if self._rule_key_column is None:
+            raise ValueError(
+                "The rule key is not enabled, pass db_class_rule_key_attribute."
+            )
+        table = self._db_class.__table__
+        id_column = table.c[self._db_class.__mapper__.columns["id"].key]
+        key_column = table.c[self._rule_key_column]
+        query = (
+            select(id_column, *(table.c[key] for key in self._rule_keys))
+            .where(key_column.is_(None))
+            .limit(self._chunk_size)
+        )
+        stmt = (
+            update(table)
+            .where(id_column == bindparam("b_id"))
+            .values({key_column: bindparam("b_key")})
+        )
+        updated = 0
+        while True:
+            with self._session_scope() as session:
+                params = [
+                    {"b_id": row[0], "b_key": _rule_hash(_rule_key(row[1:]))}
+                    for row in session.execute(query)
+                ]
+                if not params:
+                    return updated
+                session.execute(stmt, params)
+            updated += len(params)
+
+    def _log_changes(self, session, op, keys):
+        """Appends op entries for the (ptype, *rule) keys to the change log, if enabled."""
+        if self._change_log is None:
+            return
+        rows = list(self._change_rows(op, keys))
+        if not rows:
+            return
+        first = self._allocate_versions(session, len(rows))
+        for version, row in enumerate(rows, first):
+            row["id"] = version
+        stmt = insert(self._change_log)
+        for chunk in _chunked(rows, self._chunk_size):
+            session.execute(stmt, chunk)
+
+    def _seed_change_version(self, session, allocated):
+        """Inserts the version counter unless it exists, with allocated versions taken.
+
+        The counter continues from the latest logged version. Returns whether it was inserted.
+        """
+        table = self._change_version
+        if session.execute(select(table.c.id).where(table.c.id == 1)).first():
+            return False
+        latest = session.execute(select(func.max(self._change_log.c.id))).scalar()
+        session.execute(insert(table).values(id=1, version=(latest or 0) + allocated))
+        return True
+
+    def _allocate_versions(self, session, size):
+        """Allocates size consecutive versions and returns the first one.
 
+        The UPDATE locks the counter row until the transaction ends. Concurrent
+        writers wait for it, so a version is only allocated once all smaller ones
+        are committed or rolled back, and a reader resuming after a version never
+        misses an earlier one committed later.
+        """
+        table = self._change_version
+        counter = table.c.id == 1
+        updated = session.execute(
+            update(table).where(counter).values(version=table.c.version + size)
+        ).rowcount
+        # the counter is missing when the tables were not created by the adapter
+        if not updated and not self._seed_change_version(session, size):
+            return self._allocate_versions(session, size)
+        last = session.execute(select(table.c.version).where(counter)).scalar()
+        return last - size + 1
+
+    def _change_log_table(self):
+        if self._change_log is None:
+            raise ValueError("The change log is not enabled, pass change_log=True.")
+        return self._change_log
+
+    @_instrumented
+    def current_version(self):
+        """Returns the version of the latest change log entry, 0 if there is none."""
+        table = self._change_log_table()
+        with self._session_scope(self._engine) as session:
+            version = session.execute(select(func.max(table.c.id))).scalar()
+        return version or 0
+
+    @_instrumented
+    def load_policy_delta(self, model, since_version):
+        """Applies the changes logged after since_version to the model.
+
+        Returns the version of the latest applied change, to pass on the next call.
+        Role links are not rebuilt, call ``build_role_links`` of the enforcer afterwards.
+        Applying a change twice has no effect, so a node can read ``current_version``
+        before a full ``load_policy`` and load the deltas from there.
+
+        Raises ValueError if the changes since that version were pruned, in which case
+        the full policy needs to be loaded again.
+        """
+        table = self._change_log_table()
+        version = since_version
+        with self._session_scope(self._engine) as session:
+            pruned = session.execute(
+                select(func.max(table.c.id)).where(table.c.op == "pruned")
+            ).scalar()
+            if pruned is not None and pruned > since_version:
+                raise ValueError(
+                    f"The change log was pruned up to version {pruned}, "
+                    f"changes since version {since_version} are lost."
+                )
+
+            # Apply the changes to ordered dicts of the touched policies instead of
+            # the lists, so that each change costs O(1)
+            policies = {}
+            query = select(table).where(table.c.id > since_version).order_by(table.c.id)
+            for row in self._stream(session, query):
+                version = row.id
+                fields = tuple(row)[2:]
+                ptype = fields[0]
+                rules = policies.get(ptype)
+                if rules is None:
+                    policy = _policy_of(model, ptype)
+                    if policy is None:
+                        continue
+                    rules = policies[ptype] = {tuple(rule): rule for rule in policy}
+
+                if row.op == "add":
+                    key = _rule_key(fields)[1:]
+                    rules.setdefault(key, list(key))
+                elif row.op == "remove":
+                    rules.pop(_rule_key(fields)[1:], None)
+                elif row.op == "remove_filtered":
+                    values = [(i, v) for i, v in enumerate(fields[1:]) if v is not None]
+                    for key in [
+                        key
+                        for key in rules
+                        if all(i < len(key) and key[i] == v for i, v in values)
+                    ]:
+                        del rules[key]
+
+        for ptype, rules in policies.items():
+            model.model[ptype[0]][ptype].policy = list(rules.values())
+
+        return version
+
+    @_instrumented
+    def prune_change_log(self, version):
+        """Deletes the change log entries up to version.
+
+        The newest pruned entry is kept as a marker, so that ``load_policy_delta``
+        detects when it is asked for changes that are gone.
+        """
+        table = self._change_log_table()
+        with self._session_scope() as session:
+            last = session.execute(
+                select(func.max(table.c.id)).where(table.c.id <= version)
+            ).scalar()
+            if last is None:
+                return 0
+            pruned = session.execute(delete(table).where(table.c.id < last)).rowcount
+            session.execute(
+                update(table)
+                .where(table.c.id == last)
+                .values({"op": "pruned", **{attr: None for attr in _RULE_ATTRS}})
+            )
+        return pruned
+
+    @_instrumented
     def save_policy(self, model):
         """saves all policy rules to the storage."""
 
         # Use the default strategy when soft delete is not enabled
-        if self.softdelete_attribute is None:
+        if self.softdelete_attribute is None and not self._incremental_save:
             with self._session_scope() as session:
-                query = session.query(self._db_class)
-                query.delete()
-                for sec in ["p", "g"]:
-                    if sec not in model.model.keys():
-                        continue
-                    for ptype, ast in model.model[sec].items():
-                        for rule in ast.policy:
-                            self._save_policy_line(ptype, rule, session=session)
+                if self._change_log is not None:
+                    query = self._id_rule_select()
+                    added, removed, _ = self._policy_diff(
+                        self._stream(session, query), model
+                    )
+                    self._log_changes(session, "remove", removed)
+                    self._log_changes(session, "add", added)
+                session.execute(delete(self._db_class))
+                self._bulk_load(session, self._model_rows(model))
             return True
 
         # Custom stategy for softdelete since it does not make sense to recreate all of the
-        # entries when using soft delete
+        # entries when using soft delete, and for incremental_save: diff the live rows
+        # against the model in memory and only write the changes
         with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-
-            # Delete entries that are not part of the model anymore
-            lines_before_changes = query.all()
-
-            # Create new entries in the database
-            for sec in ["p", "g"]:
-                if sec not in model.model.keys():
-                    continue
-                for ptype, ast in model.model[sec].items():
-                    for rule in ast.policy:
-                        # Filter for rule in the database
-                        filter_query = query.filter(self._db_class.ptype == ptype)
-                        for index, value in enumerate(rule):
-                            v_value = getattr(self._db_class, "v{}".format(index))
-                            filter_query = filter_query.filter(v_value == value)
-                        # If the rule is not present, create an entry in the database
-                        if filter_query.count() == 0:
-                            self._save_policy_line(ptype, rule, session=session)
-
-            for line in lines_before_changes:
-                ptype = line.ptype
-                sec = ptype[0]  # derived from persist.load_policy_line function
-                fields_with_None = [
-                    line.v0,
-                    line.v1,
-                    line.v2,
-                    line.v3,
-                    line.v4,
-                    line.v5,
-                ]
-                rule = [element for element in fields_with_None if element is not None]
-                # If the the rule is not part of the model, set the deletion flag to True
-                if not model.has_policy(sec, ptype, rule):
-                    setattr(line, self.softdelete_attribute.name, True)
+            query = self._softdelete_query(self._id_rule_select())
+            added, removed, duplicates = self._policy_diff(
+                self._stream(session, query), model
+            )
+            # Create entries for rules missing in the database
+            self._bulk_load(
+                session, (self._rule_row(key[0], rule) for key, rule in added.items())
+            )
+            # Remove entries that are not part of the model anymore, and duplicates
+            stale_ids = (line_id for ids in removed.values() for line_id in ids)
+            for stmt in self._remove_ids_statements(chain(stale_ids, duplicates)):
+                session.execute(stmt)
+            self._log_changes(session, "remove", removed)
+            self._log_changes(session, "add", added)
 
         return True
 
+    @_instrumented
+    def import_policies(self, rules, progress=None, transaction_size=50000):
+        """Adds the rules, e.g. from iter_policies or a policy file, without holding them all in memory.
+
+        rules yields (ptype, v0, ...) sequences or policy lines like ``p, alice, data1, read``,
+        blank lines and ``#`` comments are skipped. Lines are split like casbin splits
+        policy files, at commas outside brackets and without CSV quoting; pass the rows of
+        ``csv.reader(f, skipinitialspace=True)`` to import a CSV export. The rules are
+        written with the bulk loader in one transaction per transaction_size rules, after
+        each of which progress, if given, is called with the number of rules imported so
+        far. Rules already stored are added again unless ``unique_rules`` is enabled.
+
+        Returns the number of rules imported.
+        """
+        keys = (
+            _policy_fields(rule) if isinstance(rule, str) else rule for rule in rules
+        )
+        keys = (tuple(key) for key in keys if key)
+        imported = 0
+        for chunk in _chunked(keys, transaction_size):
+            with self._session_scope() as session:
+                self._bulk_load(session, (self._rule_row(k[0], k[1:]) for k in chunk))
+                self._log_changes(session, "add", chunk)
+            imported += len(chunk)
+            if progress is not None:
+                progress(imported)
+        return imported
+
+    @_instrumented
     def add_policy(self, sec, ptype, rule):
         """adds a policy rule to the storage."""
-        self._save_policy_line(ptype, rule)
+        if self._write_buffer is not None and self._bound_session() is None:
+            self._write_buffer.add((ptype, *rule))
+            return
+        with self._session_scope() as session:
+            self._save_policy_line(ptype, rule, session=session)
+            self._log_changes(session, "add", [(ptype, *rule)])
 
+    @_instrumented
     def add_policies(self, sec, ptype, rules):
         """adds a policy rules to the storage."""
-        for rule in rules:
-            self._save_policy_line(ptype, rule)
+        # read twice, for the rows and the change log
+        rules = list(rules)
+        with self._session_scope() as session:
+            self._bulk_insert(session, (self._rule_row(ptype, rule) for rule in rules))
+            self._log_changes(session, "add", ((ptype, *rule) for rule in rules))
 
+    @_instrumented
     def remove_policy(self, sec, ptype, rule):
         """removes a policy rule from the storage."""
+        if self._write_buffer is not None and self._bound_session() is None:
+            # whether the rule was stored is only known when the buffer is written
+            self._write_buffer.remove((ptype, *rule))
+            return True
         with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            query = query.filter(self._db_class.ptype == ptype)
-            for i, v in enumerate(rule):
-                query = query.filter(getattr(self._db_class, "v{}".format(i)) == v)
-
-            if self.softdelete_attribute is None:
-                r = query.delete()
-            else:
-                r = query.update({self.softdelete_attribute: True})
+            r = session.execute(*self._remove_rule_statement(ptype, rule)).rowcount
+            if r > 0:
+                self._log_changes(session, "remove", [(ptype, *rule)])
 
         return True if r > 0 else False
 
+    @_instrumented
     def remove_policies(self, sec, ptype, rules):
         """remove policy rules from the storage."""
+        rules = list(rules)
         if not rules:
             return
+        removed = 0
         with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            query = query.filter(self._db_class.ptype == ptype)
-            rules = zip(*rules)
-            for i, rule in enumerate(rules):
-                query = query.filter(
-                    or_(getattr(self._db_class, "v{}".format(i)) == v for v in rule)
-                )
+            for clause in self._rules_clauses(ptype, rules):
+                removed += session.execute(self._remove_statement(clause)).rowcount
+            if removed > 0:
+                self._log_changes(session, "remove", ((ptype, *rule) for rule in rules))
 
-            if self.softdelete_attribute is None:
-                query.delete()
-            else:
-                query.update({self.softdelete_attribute: True})
+        return removed > 0
 
+    @_instrumented
     def remove_filtered_policy(self, sec, ptype, field_index, *field_values):
         """removes policy rules that match the filter from the storage.
         This is part of the Auto-Save feature.
         """
+        statement = self._remove_filtered_statement(ptype, field_index, field_values)
+        if statement is None:
+            return False
         with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            query = query.filter(self._db_class.ptype == ptype)
-
-            if not (0 <= field_index <= 5):
-                return False
-            if not (1 <= field_index + len(field_values) <= 6):
-                return False
-            for i, v in enumerate(field_values):
-                if v != "":
-                    v_value = getattr(self._db_class, "v{}".format(field_index + i))
-                    query = query.filter(v_value == v)
-
-            if self.softdelete_attribute is None:
-                r = query.delete()
-            else:
-                r = query.update({self.softdelete_attribute: True})
+            r = session.execute(*statement).rowcount
+            if r > 0 and self._change_log is not None:
+                # Record the filter instead of the removed rules, empty values match anything
+                values = [None] * field_index + [
+                    v if v != "" else None for v in field_values
+                ]
+                self._log_changes(session, "remove_filtered", [(ptype, *values)])
 
         return True if r > 0 else False
 
+    def _remove_returning(self, session, clause):
+        """Removes the live rows matching clause and returns their (ptype, v0, ...) keys.
+
+        Databases without ``RETURNING`` read the rows with a locking SELECT first and
+        remove them by id.
+        """
+        stmt = self._remove_returning_statement(clause)
+        if stmt is not None:
+            return [_rule_key(row) for row in session.execute(stmt)]
+        rows = session.execute(self._locked_rule_ids_query(clause)).all()
+        for stmt in self._remove_ids_statements([row[0] for row in rows]):
+            session.execute(stmt)
+        return [_rule_key(row[1:]) for row in rows]
+
+    @_instrumented
+    def remove_policies_returning(self, sec, ptype, rules):
+        """Removes policy rules from the storage and returns the rules of the removed rows.
+
+        A rule stored several times is returned once per row, rules not stored are
+        left out.
+        """
+        removed = []
+        with self._session_scope() as session:
+            for clause in self._rules_clauses(ptype, rules):
+                removed.extend(self._remove_returning(session, clause))
+            self._log_changes(session, "remove", removed)
+        return [list(key[1:]) for key in removed]
+
+    @_instrumented
+    def remove_filtered_policy_returning(self, sec, ptype, field_index, *field_values):
+        """Removes the policy rules that match the filter and returns them.
+
+        Like remove_filtered_policy, empty field values match anything. The removals
+        are recorded in the change log rule by rule instead of as the filter.
+        """
+        clause = self._filtered_clause(ptype, field_index, field_values)
+        if clause is None:
+            return []
+        with self._session_scope() as session:
+            removed = self._remove_returning(session, clause)
+            self._log_changes(session, "remove", removed)
+        return [list(key[1:]) for key in removed]
+
+    @_instrumented
     def update_policy(
         self, sec: str, ptype: str, old_rule: list[str], new_rule: list[str]
     ) -> None:
@@ -301,89 +1626,78 @@ class Adapter(persist.Adapter, persist.adapters.UpdateAdapter):
         """
 
         with self._session_scope() as session:
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            query = query.filter(self._db_class.ptype == ptype)
-
-            # locate the old rule
-            for index, value in enumerate(old_rule):
-                v_value = getattr(self._db_class, "v{}".format(index))
-                query = query.filter(v_value == value)
-
-            # need the length of the longest_rule to perform overwrite
-            longest_rule = old_rule if len(old_rule) > len(new_rule) else new_rule
-            old_rule_line = query.one()
-
-            # overwrite the old rule with the new rule
-            for index in range(len(longest_rule)):
-                if index < len(new_rule):
-                    exec(f"old_rule_line.v{index} = new_rule[{index}]")
-                else:
-                    exec(f"old_rule_line.v{index} = None")
-
+            # overwrite the old rule with the new rule, which has to match exactly one row
+            r = session.execute(
+                *self._update_rule_statement(ptype, old_rule, new_rule)
+            ).rowcount
+            self._check_one_updated(r)
+            self._log_changes(session, "remove", [(ptype, *old_rule)])
+            self._log_changes(session, "add", [(ptype, *new_rule)])
+
+    @_instrumented
     def update_policies(
         self,
         sec: str,
         ptype: str,
         old_rules: list[list[str]],
         new_rules: list[list[str]],
-    ) -> None:
+    ) -> list[list[str]]:
         """
         Update the old_rules with the new_rules in the database (storage).
 
+        The old rules are looked up with chunked queries and all matching rows are
+        updated with a single executemany UPDATE, in one transaction.
+
         :param sec: section type
         :param ptype: policy type
         :param old_rules: the old rules that need to be modified
         :param new_rules: the new rules to replace the old rules
 
-        :return: None
+        :return: the old rules that were not found in the database
         """
-        for i in range(len(old_rules)):
-            self.update_policy(sec, ptype, old_rules[i], new_rules[i])
+        old_rules, new_rules = list(old_rules), list(new_rules)
+        with self._session_scope() as session:
+            ids = {}
+            for query in self._rule_ids_queries(ptype, old_rules):
+                for row in self._stream(session, query):
+                    ids.setdefault(_rule_key(row[1:]), []).append(row[0])
+
+            stmt, params, not_found = self._update_by_id(
+                ptype, old_rules, new_rules, ids
+            )
+            for chunk in _chunked(params, self._chunk_size):
+                session.execute(stmt, chunk)
+
+            if self._change_log is not None:
+                updated = [
+                    (old_rule, new_rule)
+                    for old_rule, new_rule in zip(old_rules, new_rules)
+                    if (ptype, *old_rule) in ids
+                ]
+                self._log_changes(session, "remove", ((ptype, *o) for o, _ in updated))
+                self._log_changes(session, "add", ((ptype, *n) for _, n in updated))
 
+        return not_found
+
+    @_instrumented
     def update_filtered_policies(
         self, sec, ptype, new_rules: list[list[str]], field_index, *field_values
     ) -> list[list[str]]:
-        """update_filtered_policies updates all the policies on the basis of the filter."""
-
-        filter = Filter()
-        filter.ptype = ptype
-
-        # Creating Filter from the field_index & field_values provided
-        for i in range(len(field_values)):
-            if field_index <= i and i < field_index + len(field_values):
-                setattr(filter, f"v{i}", field_values[i - field_index])
-            else:
-                break
-
-        self._update_filtered_policies(new_rules, filter)
-
-    def _update_filtered_policies(self, new_rules, filter) -> list[list[str]]:
-        """_update_filtered_policies updates all the policies on the basis of the filter."""
+        """update_filtered_policies replaces the policies matching the filter with new_rules.
 
+        Returns the replaced rules, removed and read in one statement where the
+        database supports ``RETURNING``.
+        """
+        clause = self._filtered_clause(ptype, field_index, field_values)
+        if clause is None:
+            return []
+        new_rules = list(new_rules)
         with self._session_scope() as session:
-            # Load old policies
-
-            query = session.query(self._db_class)
-            query = self._softdelete_query(query)
-            query = query.filter(self._db_class.ptype == filter.ptype)
-            filtered_query = self.filter_query(query, filter)
-            old_rules = filtered_query.all()
-
-            # Delete old policies
-
-            self.remove_policies("p", filter.ptype, old_rules)
-
-            # Insert new policies
-
-            self.add_policies("p", filter.ptype, new_rules)
-
-            # return deleted rules
-
-            return old_rules
-
-    def _softdelete_query(self, query):
-        query_softdelete = query
-        if self.softdelete_attribute is not None:
-            query_softdelete = query_softdelete.where(not_(self.softdelete_attribute))
-        return query_softdelete
+            removed = self._remove_returning(session, clause)
+            self._bulk_insert(
+                session, (self._rule_row(ptype, rule) for rule in new_rules)
+            )
+            self._log_changes(session, "remove", removed)
+            self._log_changes(session, "add", ((ptype, *rule) for rule in new_rules))
+
+        return [list(key[1:]) for key in removed]
@@ -0,0 +1,297 @@
+from contextlib import asynccontextmanager
+from itertools import chain
+
+from casbin.persist.adapters.asyncio import (
+    AsyncAdapter as AsyncAdapterBase,
+    AsyncBatchAdapter,
+    AsyncFilteredAdapter,
+    AsyncUpdateAdapter,
+)
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from .adapter import _RuleStatements, _chunked, _created_schemas, _rule_key, _schema_key
+
+
+class AsyncAdapter(
+    AsyncAdapterBase,
+    AsyncBatchAdapter,
+    AsyncFilteredAdapter,
+    AsyncUpdateAdapter,
+    _RuleStatements,
+):
+    """the interface for async Casbin adapters, running on an SQLAlchemy AsyncEngine."""
+
+    def __init__(
+        self,
+        engine,
+        db_class=None,
+        db_class_softdelete_attribute=None,
+        filtered=False,
+        create_all_models=True,
+        chunk_size=1000,
+        index_rules=False,
+        unique_rules=False,
+        db_class_rule_key_attribute=None,
+        incremental_save=False,
+    ):
+        if isinstance(engine, str):
+            self._engine = create_async_engine(engine)
+        else:
+            self._engine = engine
+
+        self._configure(
+            db_class,
+            db_class_softdelete_attribute,
+            filtered,
+            chunk_size,
+            index_rules,
+            unique_rules,
+            db_class_rule_key_attribute,
+        )
+        self.session_local = sessionmaker(
+            bind=self._engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self._incremental_save = incremental_save
+        # The tables cannot be created from __init__ without blocking, see create_table
+        self._create_all_models = create_all_models
+
+    @property
+    def _dialect(self):
+        return self._engine.sync_engine.dialect
+
+    async def create_table(self):
+        """Creates the tables of the models, this is done on first use by default.
+
+        Nothing is done if this process created them in the database already.
+        """
+        metadata = self._db_class.metadata
+        key = _schema_key(self._engine.url, metadata.sorted_tables, self._rule_indexes)
+        if key not in _created_schemas:
+            async with self._engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+                for index in self._rule_indexes:
+                    await conn.run_sync(index.create, checkfirst=True)
+            if key is not None:
+                _created_schemas.add(key)
+        self._create_all_models = False
+
+    @asynccontextmanager
+    async def _session_scope(self):
+        """Provide a transactional scope around a series of operations."""
+        if self._create_all_models:
+            await self.create_table()
+        session = self._bound_session()
+        if session is not None:
+            # join the transaction of the caller, who commits it
+            yield session
+            return
+        session = self.session_local()
+        try:
+            yield session
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            raise e
+        finally:
+            await session.close()
+
+    def is_filtered(self):
+        # Not a coroutine: the enforcer calls it synchronously
+        return self._filtered
+
+    async def _load(self, session, query, model):
+        """Streams the query results into the model in chunks of ``chunk_size`` rows."""
+        result = await session.stream(query)
+        async for rows in result.partitions(self._chunk_size):
+            self._load_policy_rows(rows, model)
+
+    async def load_policy(self, model):
+        """loads all policy rules from the storage."""
+        async with self._session_scope() as session:
+            query = self._softdelete_query(self._rule_select())
+            await self._load(session, query, model)
+
+    async def load_filtered_policy(self, model, filter) -> None:
+        """loads all policy rules from the storage."""
+        async with self._session_scope() as session:
+            query = self._softdelete_query(self._rule_select())
+            query = self.filter_query(query, filter)
+            await self._load(session, query, model)
+            self._filtered = True
+
+    async def _bulk_insert(self, session, rows):
+        """Inserts rule rows using one executemany INSERT per chunk of ``chunk_size`` rows."""
+        stmt = self._cached_statement(("insert",), self._insert_statement)
+        for chunk in _chunked(rows, self._chunk_size):
+            await session.execute(stmt, chunk)
+
+    async def save_policy(self, model):
+        """saves all policy rules to the storage."""
+
+        # Use the default strategy when soft delete is not enabled
+        if self.softdelete_attribute is None and not self._incremental_save:
+            async with self._session_scope() as session:
+                await session.execute(delete(self._db_class))
+                await self._bulk_insert(session, self._model_rows(model))
+            return True
+
+        # Soft delete and incremental_save: diff the live rows against the model in memory
+        async with self._session_scope() as session:
+            query = self._softdelete_query(self._id_rule_select())
+            result = await session.stream(query)
+            rows = [row async for row in result]
+            added, removed, duplicates = self._policy_diff(rows, model)
+            await self._bulk_insert(
+                session, (self._rule_row(key[0], rule) for key, rule in added.items())
+            )
+            stale_ids = (line_id for ids in removed.values() for line_id in ids)
+            for stmt in self._remove_ids_statements(chain(stale_ids, duplicates)):
+                await session.execute(stmt)
+
+        return True
+
+    async def add_policy(self, sec, ptype, rule):
+        """adds a policy rule to the storage."""
+        async with self._session_scope() as session:
+            await self._bulk_insert(session, [self._rule_row(ptype, rule)])
+
+    async def add_policies(self, sec, ptype, rules):
+        """adds a policy rules to the storage."""
+        async with self._session_scope() as session:
+            await self._bulk_insert(
+                session, (self._rule_row(ptype, rule) for rule in rules)
+            )
+
+    async def remove_policy(self, sec, ptype, rule):
+        """removes a policy rule from the storage."""
+        async with self._session_scope() as session:
+            r = (
+                await session.execute(*self._remove_rule_statement(ptype, rule))
+            ).rowcount
+
+        return True if r > 0 else False
+
+    async def remove_policies(self, sec, ptype, rules):
+        """remove policy rules from the storage."""
+        if not rules:
+            return
+        removed = 0
+        async with self._session_scope() as session:
+            for clause in self._rules_clauses(ptype, rules):
+                removed += (
+                    await session.execute(self._remove_statement(clause))
+                ).rowcount
+
+        return removed > 0
+
+    async def remove_filtered_policy(self, sec, ptype, field_index, *field_values):
+        """removes policy rules that match the filter from the storage.
+        This is part of the Auto-Save feature.
+        """
+        statement = self._remove_filtered_statement(ptype, field_index, field_values)
+        if statement is None:
+            return False
+        async with self._session_scope() as session:
+            r = (await session.execute(*statement)).rowcount
+
+        return True if r > 0 else False
+
+    async def _remove_returning(self, session, clause):
+        """Removes the live rows matching clause and returns their (ptype, v0, ...) keys."""
+        stmt = self._remove_returning_statement(clause)
+        if stmt is not None:
+            return [_rule_key(row) for row in await session.execute(stmt)]
+        rows = (await session.execute(self._locked_rule_ids_query(clause))).all()
+        for stmt in self._remove_ids_statements([row[0] for row in rows]):
+            await session.execute(stmt)
+        return [_rule_key(row[1:]) for row in rows]
+
+    async def remove_policies_returning(self, sec, ptype, rules):
+        """Removes policy rules from the storage and returns the rules of the removed rows."""
+        removed = []
+        async with self._session_scope() as session:
+            for clause in self._rules_clauses(ptype, rules):
+                removed.extend(await self._remove_returning(session, clause))
+        return [list(key[1:]) for key in removed]
+
+    async def remove_filtered_policy_returning(
+        self, sec, ptype, field_index, *field_values
+    ):
+        """Removes the policy rules that match the filter and returns them."""
+        clause = self._filtered_clause(ptype, field_index, field_values)
+        if clause is None:
+            return []
+        async with self._session_scope() as session:
+            removed = await self._remove_returning(session, clause)
+        return [list(key[1:]) for key in removed]
+
+    async def update_policy(
+        self, sec: str, ptype: str, old_rule: list[str], new_rule: list[str]
+    ) -> None:
+        """
+        Update the old_rule with the new_rule in the database (storage).
+
+        :param sec: section type
+        :param ptype: policy type
+        :param old_rule: the old rule that needs to be modified
+        :param new_rule: the new rule to replace the old rule
+
+        :return: None
+        """
+
+        async with self._session_scope() as session:
+            statement = self._update_rule_statement(ptype, old_rule, new_rule)
+            self._check_one_updated((await session.execute(*statement)).rowcount)
+
+    async def update_policies(
+        self,
+        sec: str,
+        ptype: str,
+        old_rules: list[list[str]],
+        new_rules: list[list[str]],
+    ) -> list[list[str]]:
+        """
+        Update the old_rules with the new_rules in the database (storage).
+
+        :param sec: section type
+        :param ptype: policy type
+        :param old_rules: the old rules that need to be modified
+        :param new_rules: the new rules to replace the old rules
+
+        :return: the old rules that were not found in the database
+        """
+        old_rules, new_rules = list(old_rules), list(new_rules)
+        async with self._session_scope() as session:
+            ids = {}
+            for query in self._rule_ids_queries(ptype, old_rules):
+                for row in await session.execute(query):
+                    ids.setdefault(_rule_key(row[1:]), []).append(row[0])
+
+            stmt, params, not_found = self._update_by_id(
+                ptype, old_rules, new_rules, ids
+            )
+            for chunk in _chunked(params, self._chunk_size):
+                await session.execute(stmt, chunk)
+
+        return not_found
+
+    async def update_filtered_policies(
+        self, sec, ptype, new_rules: list[list[str]], field_index, *field_values
+    ) -> list[list[str]]:
+        """update_filtered_policies replaces the policies matching the filter with new_rules.
+
+        Returns the replaced rules.
+        """
+
+        clause = self._filtered_clause(ptype, field_index, field_values)
+        if clause is None:
+            return []
+        async with self._session_scope() as session:
+            removed = await self._remove_returning(session, clause)
+            await self._bulk_insert(
+                session, (self._rule_row(ptype, rule) for rule in new_rules)
+            )
+
+        return [list(key[1:]) for key in removed]
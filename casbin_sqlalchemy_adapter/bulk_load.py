@@ -0,0 +1,164 @@
+"""Bulk loading of rule rows for full policy rewrites.
+
+``save_policy`` writes every rule of the model at once. A :class:`BulkLoader`
+inserts those rows the fastest way the database and its driver offer. The
+adapter picks the loader of its dialect with :func:`bulk_loader_for`, unless it
+is given one.
+"""
+
+import io
+from itertools import chain, islice
+from operator import itemgetter
+
+from sqlalchemy.dialects import postgresql
+
+
+def _chunked(iterable, size):
+    """Yields lists of at most size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _copy_text(value):
+    """Formats a value as a field of the text format of PostgreSQL's COPY."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class BulkLoader:
+    """Inserts rows with one executemany INSERT per batch, on any database.
+
+    batch_size overrides the ``chunk_size`` of the adapter.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+
+    def load(self, connection, stmt, rows, batch_size):
+        """Inserts rows, dicts of column values that all have the same keys, with the INSERT stmt."""
+        for batch in _chunked(rows, self.batch_size or batch_size):
+            connection.execute(stmt, batch)
+
+    @staticmethod
+    def _peek(rows):
+        """Returns the column keys of the first row, or None when there are no rows, and all rows."""
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return None, ()
+        return list(first), chain([first], rows)
+
+    @staticmethod
+    def _bypasses_defaults(stmt, keys):
+        """Whether columns missing from keys have Python-side defaults, which only SQLAlchemy applies."""
+        return any(
+            column.default is not None and column.key not in keys
+            for column in stmt.table.columns
+        )
+
+
+class SQLiteBulkLoader(BulkLoader):
+    """Runs the compiled INSERT with the executemany of the driver, in batches of 10000 rows.
+
+    The rows are passed as tuples, skipping the per-row parameter processing of
+    SQLAlchemy. While loading, the page cache of the connection is enlarged to
+    cache_size (in KiB when negative, see ``PRAGMA cache_size``), so that a large
+    rewrite is not spilled to the database file before the commit.
+    """
+
+    def __init__(self, batch_size=10000, cache_size=-65536):
+        super().__init__(batch_size)
+        self.cache_size = cache_size
+
+    def load(self, connection, stmt, rows, batch_size):
+        keys, rows = self._peek(rows)
+        if keys is None:
+            return
+        if self._bypasses_defaults(stmt, keys):
+            return super().load(connection, stmt, rows, batch_size)
+
+        compiled = stmt.compile(dialect=connection.dialect, column_keys=keys)
+        # itemgetter of several keys returns the tuple of their values
+        values = itemgetter(*compiled.positiontup)
+        previous = connection.exec_driver_sql("PRAGMA cache_size").scalar()
+        connection.exec_driver_sql("PRAGMA cache_size = {:d}".format(self.cache_size))
+        try:
+            for batch in _chunked(rows, self.batch_size or batch_size):
+                connection.exec_driver_sql(compiled.string, list(map(values, batch)))
+        finally:
+            connection.exec_driver_sql("PRAGMA cache_size = {:d}".format(previous))
+
+
+class MultiValuesBulkLoader(BulkLoader):
+    """Inserts every batch with a single multi-row ``INSERT ... VALUES`` statement, e.g. on MySQL."""
+
+    def load(self, connection, stmt, rows, batch_size):
+        for batch in _chunked(rows, self.batch_size or batch_size):
+            connection.execute(stmt.values(batch))
+
+
+class PostgreSQLBulkLoader(BulkLoader):
+    """Streams the rows with ``COPY ... FROM STDIN`` on psycopg 3 and psycopg2.
+
+    Other drivers, INSERTs that skip conflicting rules (``unique_rules``) and
+    tables with Python-side column defaults fall back to executemany INSERTs.
+    The COPY runs on the DBAPI cursor, so SQLAlchemy events do not see it.
+    """
+
+    def load(self, connection, stmt, rows, batch_size):
+        keys, rows = self._peek(rows)
+        if keys is None:
+            return
+        driver = connection.dialect.driver
+        if (
+            driver not in ("psycopg", "psycopg2")
+            or isinstance(stmt, postgresql.Insert)
+            or self._bypasses_defaults(stmt, keys)
+        ):
+            return super().load(connection, stmt, rows, batch_size)
+
+        table = stmt.table
+        preparer = connection.dialect.identifier_preparer
+        copy_sql = "COPY {} ({}) FROM STDIN".format(
+            preparer.format_table(table),
+            ", ".join(preparer.format_column(table.c[key]) for key in keys),
+        )
+        cursor = connection.connection.cursor()
+        try:
+            if driver == "psycopg":
+                with cursor.copy(copy_sql) as copy:
+                    for row in rows:
+                        copy.write_row([row[key] for key in keys])
+                return
+            for batch in _chunked(rows, self.batch_size or batch_size):
+                data = "".join(
+                    "\t".join(_copy_text(row[key]) for key in keys) + "\n"
+                    for row in batch
+                )
+                cursor.copy_expert(copy_sql, io.StringIO(data))
+        finally:
+            cursor.close()
+
+
+_LOADERS = {
+    "sqlite": SQLiteBulkLoader,
+    "postgresql": PostgreSQLBulkLoader,
+    "mysql": MultiValuesBulkLoader,
+    "mariadb": MultiValuesBulkLoader,
+}
+
+
+def bulk_loader_for(dialect):
+    """Returns the default loader of a dialect, the generic BulkLoader for other databases."""
+    return _LOADERS.get(dialect.name, BulkLoader)()
@@ -0,0 +1,240 @@
+"""Opt-in instrumentation of the adapter operations.
+
+An :class:`AdapterMetrics` attached to an :class:`~casbin_sqlalchemy_adapter.Adapter`
+records, for every public operation, its latency, the SQL statements it issued
+and the rows it read and wrote, as well as the duration of each transaction.
+Statements are counted with SQLAlchemy engine events, only while an operation
+of the adapter runs in the current thread.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Returns the count, sum and cumulative (upper bound, count) buckets."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class _Operation:
+    """Counters of one running operation."""
+
+    def __init__(self):
+        self.statements = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.execute_seconds = 0.0
+        self.fetch_seconds = 0.0
+
+    def add(self, other):
+        self.statements += other.statements
+        self.rows_read += other.rows_read
+        self.rows_written += other.rows_written
+        self.execute_seconds += other.execute_seconds
+        self.fetch_seconds += other.fetch_seconds
+
+
+class _OperationStats:
+    """Totals of all the calls of one operation."""
+
+    def __init__(self, buckets):
+        self.calls = 0
+        self.errors = 0
+        self.latency = _Histogram(buckets)
+        self.statements = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.execute_seconds = 0.0
+        self.fetch_seconds = 0.0
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency": self.latency.snapshot(),
+            "statements": self.statements,
+            "rows_read": self.rows_read,
+            "rows_written": self.rows_written,
+            "execute_seconds": self.execute_seconds,
+            "fetch_seconds": self.fetch_seconds,
+        }
+
+
+class AdapterMetrics:
+    """Collects latency, statement and row counts of adapter operations.
+
+    ``stats()`` returns a snapshot of the totals. The optional callback is called
+    after every operation with a dict of its ``operation`` name, ``seconds``,
+    ``execute_seconds`` spent executing statements, ``fetch_seconds`` spent fetching
+    result rows, ``statements``, ``rows_read``, ``rows_written`` and ``error``,
+    e.g. to export them to a metrics system. Exceptions raised by the callback
+    propagate to the caller of the operation.
+
+    One instance can be shared by several adapters, and is safe to use from
+    multiple threads.
+    """
+
+    def __init__(self, callback=None, buckets=DEFAULT_BUCKETS):
+        self.callback = callback
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Discards all recorded values."""
+        with self._lock:
+            self._operations = {}
+            self._transactions = _Histogram(self._buckets)
+            self._commits = 0
+            self._rollbacks = 0
+
+    def stats(self):
+        """Returns a snapshot of the totals per operation and of the transactions."""
+        with self._lock:
+            return {
+                "operations": {
+                    name: stats.snapshot() for name, stats in self._operations.items()
+                },
+                "transactions": {
+                    "commits": self._commits,
+                    "rollbacks": self._rollbacks,
+                    "duration": self._transactions.snapshot(),
+                },
+            }
+
+    def attach(self, engine):
+        """Listens to the statements executed on engine."""
+        if not event.contains(engine, "before_cursor_execute", self._before_execute):
+            event.listen(engine, "before_cursor_execute", self._before_execute)
+            event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, many):
+        if getattr(self._local, "operation", None) is not None:
+            self._local.execute_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, many):
+        operation = getattr(self._local, "operation", None)
+        if operation is None:
+            return
+        operation.execute_seconds += time.perf_counter() - self._local.execute_start
+        operation.statements += 1
+        if context.isinsert or context.isupdate or context.isdelete:
+            # drivers report -1 when the count is unknown
+            operation.rows_written += max(cursor.rowcount, 0)
+
+    @contextmanager
+    def operation(self, name):
+        """Records the latency and the counters of the operation run in the block.
+
+        Operations nested in another operation are accounted to the outer one.
+        """
+        if getattr(self._local, "operation", None) is not None:
+            yield
+            return
+
+        operation = self._local.operation = _Operation()
+        error = False
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self._local.operation = None
+            with self._lock:
+                stats = self._operations.get(name)
+                if stats is None:
+                    stats = self._operations[name] = _OperationStats(self._buckets)
+                stats.calls += 1
+                stats.errors += error
+                stats.latency.observe(seconds)
+                stats.statements += operation.statements
+                stats.rows_read += operation.rows_read
+                stats.rows_written += operation.rows_written
+                stats.execute_seconds += operation.execute_seconds
+                stats.fetch_seconds += operation.fetch_seconds
+            if self.callback is not None:
+                self.callback(
+                    {
+                        "operation": name,
+                        "seconds": seconds,
+                        "execute_seconds": operation.execute_seconds,
+                        "fetch_seconds": operation.fetch_seconds,
+                        "statements": operation.statements,
+                        "rows_read": operation.rows_read,
+                        "rows_written": operation.rows_written,
+                        "error": error,
+                    }
+                )
+
+    def propagate(self, fn):
+        """Returns fn wrapped to account its statements and rows to the current operation.
+
+        The operation is tracked per thread, so wrap the functions that run the
+        queries of an operation on other threads, e.g. in a thread pool.
+        """
+        parent = getattr(self._local, "operation", None)
+        if parent is None:
+            return fn
+
+        def run(*args, **kwargs):
+            operation = self._local.operation = _Operation()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.operation = None
+                with self._lock:
+                    parent.add(operation)
+
+        return run
+
+    def transaction(self, seconds, committed):
+        """Records a transaction of the given duration."""
+        with self._lock:
+            self._transactions.observe(seconds)
+            if committed:
+                self._commits += 1
+            else:
+                self._rollbacks += 1
+
+    def fetched(self, result):
+        """Yields the rows of a result fetched in partitions, counting them and the time spent."""
+        partitions = result.partitions()
+        while True:
+            start = time.perf_counter()
+            rows = next(partitions, None)
+            operation = getattr(self._local, "operation", None)
+            if operation is not None:
+                operation.fetch_seconds += time.perf_counter() - start
+                if rows is not None:
+                    operation.rows_read += len(rows)
+            if rows is None:
+                return
+            yield from rows
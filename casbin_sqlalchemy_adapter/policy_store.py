@@ -0,0 +1,132 @@
+"""A versioned policy store shared by the processes of a host.
+
+One process loads the rules from the database and publishes them as a
+snapshot segment in the store directory, the others map the current segment
+and fill their models from it without querying the database. A ``CURRENT``
+pointer file names the current segment. Publishing writes a new segment and
+then replaces the pointer, so readers see either the old or the new version,
+never a mix. Put the directory on a memory file system like ``/dev/shm`` to keep
+the segments out of the disk.
+"""
+
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+from . import snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows, publishers are not serialized
+    fcntl = None
+
+_POINTER = "CURRENT"
+_LOCK = "LOCK"
+
+
+def _shared(rules):
+    """Returns the rules as tuples in which equal strings are the same object.
+
+    marshal writes repeated objects as references, which keeps the segment
+    small and lets the rules loaded from it share their strings as well.
+    """
+    strings = {}
+    return tuple(
+        tuple(
+            None if value is None else strings.setdefault(value, value)
+            for value in rule
+        )
+        for rule in rules
+    )
+
+
+class SharedPolicyStore:
+    """Publishes and reads versions of the policy rules in directory.
+
+    Segments of the last keep versions are retained, for readers that read the
+    pointer just before a newer version replaced it.
+    """
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def lock(self):
+        """Holds an exclusive lock on the store, across processes where fcntl is available."""
+        if fcntl is None:
+            yield
+            return
+        with open(self._path(_LOCK), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _pointer(self):
+        try:
+            with open(self._path(_POINTER)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def version(self):
+        """Returns the current version, None if nothing was published yet."""
+        pointer = self._pointer()
+        return None if pointer is None else pointer["version"]
+
+    def read(self):
+        """Returns the current version and its rules, or None if nothing was published yet."""
+        # the segment may be pruned between reading the pointer and opening it
+        for _ in range(3):
+            pointer = self._pointer()
+            if pointer is None:
+                return None
+            version = pointer["version"]
+            rules = snapshot.read_snapshot(
+                self._path(pointer["segment"]), ("store", version)
+            )
+            if rules is not None:
+                return version, rules
+        return None
+
+    def publish(self, rules):
+        """Writes the rules as a new version and makes it current, returns its version.
+
+        Call it while holding the lock when several processes may publish.
+        """
+        version = (self.version() or 0) + 1
+        segment = "segment-{}-{}".format(version, os.getpid())
+        snapshot.write_snapshot(self._path(segment), ("store", version), _shared(rules))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".pointer-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": version, "segment": segment}, f)
+            os.replace(tmp_path, self._path(_POINTER))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._prune(version)
+        return version
+
+    def _prune(self, version):
+        """Removes the segments of versions older than the last keep ones."""
+        for name in os.listdir(self.directory):
+            if not name.startswith("segment-"):
+                continue
+            try:
+                segment_version = int(name.split("-")[1])
+            except ValueError:
+                continue
+            if segment_version <= version - self.keep:
+                try:
+                    os.remove(self._path(name))
+                except FileNotFoundError:
+                    pass
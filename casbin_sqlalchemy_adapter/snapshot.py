@@ -0,0 +1,70 @@
+"""Compact binary snapshots of policy rules, for loading them without the database.
+
+A snapshot file starts with a magic number and a JSON header holding the
+fingerprint of the database it was taken from, followed by the rules as
+``(ptype, v0, ...)`` tuples serialized with :mod:`marshal`. The marshal format
+depends on the Python version, which is part of the header as well. Snapshots are
+a local cache and must not be read from untrusted locations.
+"""
+
+import json
+import marshal
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+_MAGIC = b"CSBNSNP1"
+_HEADER_SIZE = struct.Struct("<I")
+
+
+def _header(fingerprint):
+    return {
+        "fingerprint": list(fingerprint),
+        "python": list(sys.version_info[:2]),
+        "marshal": marshal.version,
+    }
+
+
+def write_snapshot(path, fingerprint, rules):
+    """Atomically writes the rules to path, tagged with the database fingerprint."""
+    header = json.dumps(_header(fingerprint)).encode()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_MAGIC)
+            f.write(_HEADER_SIZE.pack(len(header)))
+            f.write(header)
+            marshal.dump(tuple(rules), f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_snapshot(path, fingerprint=None):
+    """Returns the rules stored in path.
+
+    Returns None if there is no snapshot, it was written by another Python version
+    or, when fingerprint is given, it was taken from a different database state.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size <= len(_MAGIC) + _HEADER_SIZE.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[: len(_MAGIC)] != _MAGIC:
+                return None
+            offset = len(_MAGIC) + _HEADER_SIZE.size
+            (size,) = _HEADER_SIZE.unpack(mm[len(_MAGIC) : offset])
+            header = json.loads(mm[offset : offset + size])
+            expected = _header(fingerprint or header["fingerprint"])
+            if header != expected:
+                return None
+            with memoryview(mm) as view, view[offset + size :] as payload:
+                return marshal.loads(payload)
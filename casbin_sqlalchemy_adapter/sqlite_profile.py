@@ -0,0 +1,72 @@
+"""A performance profile for embedded SQLite databases.
+
+The profile switches file databases to write-ahead logging, where readers do not
+block the writer and commits do not need to sync the database file, and tunes
+the page cache, memory mapping and busy timeout of every connection.
+"""
+
+import weakref
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# applied in this order, journal_mode first since it changes how the others behave
+PRAGMAS = {
+    "journal_mode": "WAL",
+    # durable up to the last commit before a power loss, and never corrupt in WAL mode
+    "synchronous": "NORMAL",
+    "cache_size": -65536,  # KiB
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+    # milliseconds to wait for the lock of another writer before raising "database is locked"
+    "busy_timeout": 5000,
+}
+
+# engine -> the PRAGMA statements its connect listener executes
+_profiled_engines = weakref.WeakKeyDictionary()
+
+
+def apply_sqlite_profile(engine, **pragmas):
+    """Executes the pragmas of the profile, updated with pragmas, on every new connection of engine.
+
+    Connections already opened by the pool are not changed. The listener is added
+    once per engine, applying the profile again replaces its pragmas.
+    """
+    if engine.dialect.name != "sqlite":
+        raise ValueError(
+            f"The SQLite profile needs an SQLite engine, got {engine.dialect.name!r}."
+        )
+    statements = [
+        "PRAGMA {} = {}".format(name, value)
+        for name, value in {**PRAGMAS, **pragmas}.items()
+        if value is not None
+    ]
+    if engine in _profiled_engines:
+        _profiled_engines[engine][:] = statements
+        return engine
+    _profiled_engines[engine] = statements
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+    event.listen(engine, "connect", on_connect)
+    return engine
+
+
+def create_sqlite_engine(url, pool_size=10, **pragmas):
+    """Creates an engine for an SQLite URL with the profile applied.
+
+    File databases get a QueuePool of pool_size connections, which keeps the
+    connections and their page cache open between operations.
+    """
+    kwargs = {}
+    url = make_url(url)
+    if url.database not in (None, "", ":memory:") and "mode=memory" not in str(url):
+        kwargs = {"poolclass": QueuePool, "pool_size": pool_size}
+    return apply_sqlite_profile(create_engine(url, **kwargs), **pragmas)
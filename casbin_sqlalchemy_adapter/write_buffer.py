@@ -0,0 +1,146 @@
+"""Write-behind buffering of single-rule mutations.
+
+A :class:`WriteBuffer` queues ``add`` and ``remove`` operations per
+``(ptype, *rule)`` key and hands them to a write function in batches, when the
+buffer holds ``size`` rules or ``interval`` seconds passed. Opposing operations
+on the same rule are coalesced before they reach the database.
+"""
+
+import threading
+import time
+
+# (pending operation, new operation) -> coalesced operation.
+# The rule may already be stored, e.g. by another node, so removing an added rule
+# still deletes the stored rows, as the unbuffered calls would.
+# Re-adding a removed rule has to delete the stored rows before inserting it.
+_COALESCE = {
+    (None, "add"): "add",
+    (None, "remove"): "remove",
+    ("add", "add"): "add",
+    ("add", "remove"): "remove",
+    ("remove", "add"): "replace",
+    ("remove", "remove"): "remove",
+    ("replace", "add"): "replace",
+    ("replace", "remove"): "remove",
+}
+
+
+class FlushError(Exception):
+    """Raised when writing a batch of buffered operations failed.
+
+    ``operations`` maps the ``(ptype, *rule)`` keys of the batch, which was rolled
+    back and dropped, to their ``"add"``, ``"remove"`` or ``"replace"`` operation.
+    """
+
+    def __init__(self, operations):
+        super().__init__(
+            f"Writing {len(operations)} buffered policy operations failed."
+        )
+        self.operations = operations
+
+
+class WriteBuffer:
+    """Queues rule operations and writes them in batches with write(operations).
+
+    With background, a daemon thread writes the batches. Otherwise they are
+    written by the thread that fills the buffer, e.g. for in-memory SQLite
+    databases that other threads cannot access.
+
+    Failed background batches are passed to on_error, or raised by the next call
+    to flush or close when there is no on_error.
+    """
+
+    def __init__(self, write, size, interval, on_error=None, background=True):
+        self._write = write
+        self._size = size
+        self._interval = interval
+        self._on_error = on_error
+        self._lock = threading.Lock()
+        # serializes the writes, so that a flush returns after all earlier batches
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._error = None
+        self._closed = False
+        self._last_write = time.monotonic()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(
+                target=self._run, name="casbin-write-buffer", daemon=True
+            )
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key):
+        self._queue(key, "add")
+
+    def remove(self, key):
+        self._queue(key, "remove")
+
+    def _queue(self, key, operation):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The write buffer is closed.")
+            self._pending[key] = _COALESCE[(self._pending.get(key), operation)]
+            due = len(self._pending) >= self._size
+        if self._thread is not None:
+            if due:
+                self._wakeup.set()
+        elif due or time.monotonic() - self._last_write >= self._interval:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Writes the pending operations, raising FlushError if that fails."""
+        with self._write_lock:
+            with self._lock:
+                operations, self._pending = self._pending, {}
+            self._last_write = time.monotonic()
+            if not operations:
+                return
+            try:
+                self._write(operations)
+            except Exception as e:
+                raise FlushError(operations) from e
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self._write_pending()
+            except FlushError as e:
+                self._report(e)
+
+    def _report(self, error):
+        if self._on_error is not None:
+            try:
+                self._on_error(error)
+                return
+            except Exception as e:
+                error = e
+        with self._lock:
+            # keep the first failure, it is the most informative
+            if self._error is None:
+                self._error = error
+
+    def flush(self):
+        """Writes the pending operations, then raises the failure of an earlier background batch, if any."""
+        self._write_pending()
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Stops the background thread and writes the remaining operations."""
+        with self._lock:
+            self._closed = True
+        if self._thread is not None:
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
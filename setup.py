@@ -33,6 +33,7 @@ setup(
     ],
     packages=find_packages(),
     install_requires=install_requires,
+    extras_require={"asyncio": ["SQLAlchemy[asyncio]"]},
     python_requires=">=3.3",
     license="Apache 2.0",
     classifiers=[
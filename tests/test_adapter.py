@@ -1,15 +1,42 @@
+import csv
+import io
 import os
+import shutil
+import tempfile
+from contextlib import contextmanager
 from unittest import TestCase
 from pathlib import Path
 
 import casbin
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, create_mock_engine, event
+from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateIndex
 
 from casbin_sqlalchemy_adapter import Adapter
+from casbin_sqlalchemy_adapter import AdapterMetrics
 from casbin_sqlalchemy_adapter import Base
 from casbin_sqlalchemy_adapter import CasbinRule
+from casbin_sqlalchemy_adapter import bulk_load
 from casbin_sqlalchemy_adapter.adapter import Filter
+from casbin_sqlalchemy_adapter.write_buffer import FlushError
+
+
+@contextmanager
+def recorded_statements(engine):
+    """Records the SQL statements executed on engine within the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
 
 
 class TestConfig(TestCase):
@@ -60,6 +87,194 @@ class TestConfig(TestCase):
         s.commit()
         self.assertEqual(s.query(CustomRule).all()[0].not_exist, "NotNone")
 
+    def test_unique_rules(self):
+        class UniqueRule(Base):
+            __tablename__ = "casbin_rule_unique"
+            __table_args__ = {"extend_existing": True}
+
+            id = Column(Integer, primary_key=True)
+            ptype = Column(String(255))
+            v0 = Column(String(255))
+            v1 = Column(String(255))
+            v2 = Column(String(255))
+            v3 = Column(String(255))
+            v4 = Column(String(255))
+            v5 = Column(String(255))
+
+        engine = create_engine("sqlite://")
+        adapter = Adapter(engine, UniqueRule, unique_rules=True)
+
+        with engine.connect() as conn:
+            indexes = conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).scalars()
+            self.assertLessEqual(
+                {"ix_casbin_rule_unique_rule", "uq_casbin_rule_unique_rule"},
+                set(indexes),
+            )
+
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.add_policies(
+            "g", "g", [["alice", "admin"], ["alice", "admin"], ["bob", "admin"]]
+        )
+
+        s = sessionmaker(bind=engine)()
+        self.assertEqual(s.query(UniqueRule).count(), 3)
+        s.close()
+
+    def test_rule_indexes_per_adapter(self):
+        unique_engine = create_engine("sqlite://")
+        Adapter(unique_engine, index_rules=True, unique_rules=True)
+
+        # the indexes of the first adapter are not declared on the shared table
+        engine = create_engine("sqlite://")
+        adapter = Adapter(engine)
+        with engine.connect() as conn:
+            indexes = set(
+                conn.exec_driver_sql(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                ).scalars()
+            )
+        self.assertNotIn("uq_casbin_rule_rule", indexes)
+        self.assertNotIn("ix_casbin_rule_rule", indexes)
+
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        s = sessionmaker(bind=engine)()
+        self.assertEqual(s.query(CasbinRule).count(), 2)
+        s.close()
+
+    def test_unique_rules_mysql_ddl(self):
+        class SoftDeleteRule(Base):
+            __tablename__ = "casbin_rule_mysql"
+            __table_args__ = {"extend_existing": True}
+
+            id = Column(Integer, primary_key=True)
+            ptype = Column(String(255))
+            v0 = Column(String(255))
+            v1 = Column(String(255))
+            v2 = Column(String(255))
+            v3 = Column(String(255))
+            v4 = Column(String(255))
+            v5 = Column(String(255))
+            is_deleted = Column(Boolean, default=False, nullable=False)
+
+        engine = create_mock_engine("mysql://", None)
+        fields = ", ".join(
+            "md5(coalesce({}, ''))".format(c)
+            for c in ("ptype", "v0", "v1", "v2", "v3", "v4", "v5")
+        )
+
+        # the coalesced fields exceed the key length of InnoDB, their hash is indexed
+        adapter = Adapter(engine, unique_rules=True, create_all_models=False)
+        ddl = [str(CreateIndex(i).compile(engine)) for i in adapter._rule_indexes]
+        self.assertEqual(
+            ddl,
+            [
+                "CREATE INDEX ix_casbin_rule_rule ON casbin_rule "
+                "(ptype(64), v0(64), v1(64), v2(64), v3(64), v4(64), v5(64))",
+                "CREATE UNIQUE INDEX uq_casbin_rule_rule ON casbin_rule "
+                "((md5(concat({}))))".format(fields),
+            ],
+        )
+
+        # deleted rows are left out of the unique index
+        adapter = Adapter(
+            engine,
+            SoftDeleteRule,
+            SoftDeleteRule.is_deleted,
+            unique_rules=True,
+            create_all_models=False,
+        )
+        ddl = str(CreateIndex(adapter._rule_indexes[-1]).compile(engine))
+        self.assertEqual(
+            ddl,
+            "CREATE UNIQUE INDEX uq_casbin_rule_mysql_rule ON casbin_rule_mysql "
+            "((if(is_deleted, NULL, md5(concat({})))))".format(fields),
+        )
+
+    def test_rule_key(self):
+        class KeyedRule(Base):
+            __tablename__ = "casbin_rule_keyed"
+            __table_args__ = {"extend_existing": True}
+
+            id = Column(Integer, primary_key=True)
+            ptype = Column(String(255))
+            v0 = Column(String(255))
+            v1 = Column(String(255))
+            v2 = Column(String(255))
+            v3 = Column(String(255))
+            v4 = Column(String(255))
+            v5 = Column(String(255))
+            rule_key = Column(String(32))
+
+        with self.assertRaises(ValueError):
+            Adapter("sqlite://", KeyedRule, db_class_rule_key_attribute=KeyedRule.id)
+        # the default model has no rule key column
+        with self.assertRaises(ValueError):
+            Adapter("sqlite://", db_class_rule_key_attribute=KeyedRule.rule_key)
+
+        engine = create_engine("sqlite://")
+        adapter = Adapter(
+            engine,
+            KeyedRule,
+            unique_rules=True,
+            db_class_rule_key_attribute=KeyedRule.rule_key,
+        )
+        with engine.connect() as conn:
+            indexes = conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).scalars()
+            self.assertIn("ix_casbin_rule_keyed_rule_key", set(indexes))
+            # rows written without the adapter have no key
+            conn.execute(
+                KeyedRule.__table__.insert(),
+                [
+                    dict(ptype="p", v0="alice", v1="data1", v2="read"),
+                    dict(ptype="g", v0="alice", v1="admin", v2=None),
+                ],
+            )
+            conn.commit()
+        self.assertEqual(adapter.backfill_rule_keys(), 2)
+        self.assertEqual(adapter.backfill_rule_keys(), 0)
+
+        # the key doubles as dedup key
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.add_policies(
+            "p", "p", [["bob", "data2", "write"], ["eve", "data3", "read"]]
+        )
+        adapter.update_policy(
+            "p", "p", ["bob", "data2", "write"], ["bob", "data2", "read"]
+        )
+        self.assertEqual(
+            adapter.update_policies(
+                "p",
+                "p",
+                [["eve", "data3", "read"], ["eve"]],
+                [["eve", "data4", "read"], ["eve", "x"]],
+            ),
+            [["eve"]],
+        )
+        self.assertTrue(adapter.remove_policy("g", "g", ["alice", "admin"]))
+        self.assertFalse(adapter.remove_policies("p", "p", [["alice", "data1"]]))
+        self.assertTrue(adapter.remove_policies("p", "p", [["alice", "data1", "read"]]))
+
+        s = sessionmaker(bind=engine)()
+        rows = s.query(KeyedRule).order_by(KeyedRule.id).all()
+        self.assertEqual(
+            [(row.v0, row.v1, row.v2) for row in rows],
+            [("bob", "data2", "read"), ("eve", "data4", "read")],
+        )
+        self.assertEqual(
+            [row.rule_key for row in rows],
+            [
+                adapter._rule_row("p", ["bob", "data2", "read"])["rule_key"],
+                adapter._rule_row("p", ["eve", "data4", "read"])["rule_key"],
+            ],
+        )
+        s.close()
+
     def test_enforcer_basic(self):
         e = self.get_enforcer()
 
@@ -89,6 +304,25 @@ class TestConfig(TestCase):
         self.assertTrue(res)
         self.assertTrue(e.enforce("eve", "data3", "read"))
 
+    def test_add_policies_bulk(self):
+        e = self.get_enforcer()
+        rules = [
+            ["user{}".format(i), "data{}".format(i % 7), "read"] for i in range(2500)
+        ]
+
+        self.assertTrue(e.add_policies(rules))
+        e.load_policy()
+        self.assertEqual(len(e.get_policy()), 2504)
+        self.assertTrue(e.enforce("user2499", "data0", "read"))
+
+        model = e.get_model()
+        model.clear_policy()
+        model.add_policies("p", "p", rules[:1500])
+        e.get_adapter().save_policy(model)
+        e.load_policy()
+        self.assertEqual(len(e.get_policy()), 1500)
+        self.assertFalse(e.enforce("user2499", "data0", "read"))
+
     def test_save_policy(self):
         e = self.get_enforcer()
         self.assertFalse(e.enforce("alice", "data4", "read"))
@@ -102,6 +336,141 @@ class TestConfig(TestCase):
         adapter.save_policy(model)
         self.assertTrue(e.enforce("alice", "data4", "read"))
 
+    def test_incremental_save(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+        adapter._incremental_save = True
+        engine = adapter._engine
+        table = adapter._db_class.__table__
+
+        def stored():
+            with engine.connect() as conn:
+                query = adapter._softdelete_query(
+                    table.select().with_only_columns(table.c.id, table.c.v0)
+                )
+                return sorted(tuple(row) for row in conn.execute(query))
+
+        before = stored()
+        # a duplicate of a rule that is kept
+        with engine.begin() as conn:
+            conn.execute(
+                table.insert(), dict(ptype="p", v0="bob", v1="data2", v2="write")
+            )
+
+        model = e.get_model()
+        model.remove_policy("p", "p", ["alice", "data1", "read"])
+        model.add_policy("p", "p", ["eve", "data3", "read"])
+        with recorded_statements(engine) as statements:
+            adapter.save_policy(model)
+
+        # the unchanged rows keep their ids
+        after = stored()
+        self.assertEqual(after[:-1], before[1:])
+        self.assertEqual(after[-1][1], "eve")
+        self.assertFalse(
+            any(s.startswith("DELETE FROM") and "WHERE" not in s for s in statements)
+        )
+        e.load_policy()
+        self.assertEqual(
+            e.get_policy(),
+            [
+                ["bob", "data2", "write"],
+                ["data2_admin", "data2", "read"],
+                ["data2_admin", "data2", "write"],
+                ["eve", "data3", "read"],
+            ],
+        )
+
+    def test_export_import(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+        adapter.add_policies(
+            "p",
+            "p",
+            [["user{}".format(i), "data, {}".format(i), "read"] for i in range(30)],
+        )
+        e.load_policy()
+
+        out = io.StringIO()
+        csv.writer(out).writerows(adapter.iter_policies())
+        out.seek(0)
+        rows = csv.reader(out, skipinitialspace=True)
+        filter = Filter()
+        filter.ptype = ["g"]
+        self.assertEqual(
+            list(adapter.iter_policies(filter)), [("g", "alice", "data2_admin")]
+        )
+
+        target = Adapter("sqlite://")
+        progress = []
+        self.assertEqual(
+            target.import_policies(rows, progress.append, transaction_size=10), 35
+        )
+        self.assertEqual(progress, [10, 20, 30, 35])
+        self.assertEqual(target.import_policies([("p", "eve", "data3", "read")]), 1)
+
+        # policy lines are split like casbin splits policy files
+        lines = [
+            "# policy file",
+            "",
+            "p, alice, data1, read",
+            'p, alice, data2, read, r.sub in ("a", "b")',
+            "p, bob, keyMatch(r.obj, [data3, data4]), write",
+        ]
+        lined = Adapter("sqlite://")
+        self.assertEqual(lined.import_policies(lines), 3)
+        self.assertEqual(
+            list(lined.iter_policies()),
+            [
+                ("p", "alice", "data1", "read"),
+                ("p", "alice", "data2", "read", 'r.sub in ("a", "b")'),
+                ("p", "bob", "keyMatch(r.obj, [data3, data4])", "write"),
+            ],
+        )
+
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        imported = casbin.Enforcer(str(scriptdir / "rbac_model.conf"), target)
+        self.assertEqual(
+            imported.get_policy(), e.get_policy() + [["eve", "data3", "read"]]
+        )
+        self.assertEqual(imported.get_grouping_policy(), e.get_grouping_policy())
+
+    def test_bulk_loaders(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        rules = [
+            ["user{}".format(i), "data{}".format(i % 3), "read"] for i in range(25)
+        ]
+
+        self.assertIsInstance(
+            Adapter("sqlite://")._bulk_loader, bulk_load.SQLiteBulkLoader
+        )
+        loaders = (
+            bulk_load.BulkLoader(),
+            bulk_load.SQLiteBulkLoader(batch_size=10),
+            bulk_load.MultiValuesBulkLoader(batch_size=10),
+        )
+        for loader in loaders:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                engine = create_engine("sqlite:///{}/policy.db".format(tmpdir))
+                adapter = Adapter(engine, bulk_loader=loader)
+                e = casbin.Enforcer(model_path, adapter)
+                e.add_policy("eve", "data9", "write")
+                model = e.get_model()
+                model.clear_policy()
+                for rule in rules:
+                    model.add_policy("p", "p", rule)
+                model.add_policy("g", "g", ["alice", "admin"])
+                adapter.save_policy(model)
+
+                e.load_policy()
+                self.assertEqual(e.get_policy(), rules)
+                self.assertEqual(e.get_grouping_policy(), [["alice", "admin"]])
+                with engine.connect() as conn:
+                    cache_size = conn.exec_driver_sql("PRAGMA cache_size").scalar()
+                    self.assertEqual(cache_size, -2000)
+                engine.dispose()
+
     def test_remove_policy(self):
         e = self.get_enforcer()
 
@@ -123,6 +492,40 @@ class TestConfig(TestCase):
         self.assertFalse(e.enforce("alice", "data5", "read"))
         self.assertFalse(e.enforce("alice", "data6", "read"))
 
+    def test_remove_policies_exact(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+        adapter.add_policy("p", "p", ["alice", "data2", "write"])
+
+        e.remove_policies([["alice", "data1", "read"], ["bob", "data2", "write"]])
+        e.load_policy()
+        self.assertFalse(e.enforce("alice", "data1", "read"))
+        self.assertFalse(e.enforce("bob", "data2", "write"))
+        self.assertIn(["alice", "data2", "write"], e.get_policy())
+
+        # a shorter rule does not match rows with more fields
+        self.assertFalse(adapter.remove_policies("p", "p", [["alice", "data2"]]))
+        self.assertTrue(
+            adapter.remove_policies("p", "p", [["alice", "data2", "write"]])
+        )
+        e.load_policy()
+        self.assertNotIn(["alice", "data2", "write"], e.get_policy())
+
+    def test_remove_policies_chunked(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+        rules = [["user{}".format(i), "data1", "read"] for i in range(1200)]
+        e.add_policies(rules)
+
+        adapter._supports_row_values = lambda: False
+        self.assertTrue(adapter.remove_policies("p", "p", rules[:600]))
+        del adapter._supports_row_values
+        self.assertTrue(adapter.remove_policies("p", "p", rules[600:]))
+        self.assertFalse(adapter.remove_policies("p", "p", rules))
+
+        e.load_policy()
+        self.assertEqual(len(e.get_policy()), 4)
+
     def test_remove_filtered_policy(self):
         e = self.get_enforcer()
 
@@ -157,6 +560,589 @@ class TestConfig(TestCase):
         # self.assertFalse(e.enforce('bob', 'data6', 'delete'))
         # self.assertFalse(e.enforce('eve', 'data6', 'delete'))
 
+    def test_load_policy(self):
+        e = self.get_enforcer()
+        e.add_policy("eve", "data3, data4", "read")
+
+        e.load_policy()
+        self.assertEqual(
+            e.get_policy(),
+            [
+                ["alice", "data1", "read"],
+                ["bob", "data2", "write"],
+                ["data2_admin", "data2", "read"],
+                ["data2_admin", "data2", "write"],
+                ["eve", "data3, data4", "read"],
+            ],
+        )
+        self.assertEqual(e.get_grouping_policy(), [["alice", "data2_admin"]])
+        self.assertTrue(e.enforce("eve", "data3, data4", "read"))
+
+    def test_change_log(self):
+        engine = create_engine("sqlite://")
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+
+        writer = casbin.Enforcer(model_path, Adapter(engine, change_log=True))
+        reader_adapter = Adapter(engine, change_log=True)
+        reader = casbin.Enforcer(model_path, reader_adapter)
+        version = reader_adapter.current_version()
+        self.assertEqual(version, 0)
+
+        writer.add_policies([["alice", "data1", "read"], ["bob", "data2", "write"]])
+        writer.add_grouping_policy("alice", "admin")
+        writer.add_policy("eve", "data3", "read")
+        writer.remove_policy("eve", "data3", "read")
+        writer.update_policy(["bob", "data2", "write"], ["bob", "data2", "read"])
+        writer.add_policy("carol", "data4", "write")
+        writer.remove_filtered_policy(1, "data4")
+
+        version = reader_adapter.load_policy_delta(reader.get_model(), version)
+        reader.build_role_links()
+        self.assertEqual(version, reader_adapter.current_version())
+        self.assertEqual(sorted(reader.get_policy()), sorted(writer.get_policy()))
+        self.assertEqual(reader.get_grouping_policy(), [["alice", "admin"]])
+        self.assertTrue(reader.enforce("bob", "data2", "read"))
+
+        model = writer.get_model()
+        model.clear_policy()
+        model.add_policy("p", "p", ["dave", "data5", "read"])
+        writer.save_policy()
+        version = reader_adapter.load_policy_delta(reader.get_model(), version)
+        self.assertEqual(reader.get_policy(), [["dave", "data5", "read"]])
+        self.assertEqual(reader.get_grouping_policy(), [])
+
+        # nothing changed since the last delta
+        self.assertEqual(
+            reader_adapter.load_policy_delta(reader.get_model(), version), version
+        )
+
+        writer.add_policy("frank", "data6", "read")
+        self.assertGreater(reader_adapter.prune_change_log(version), 0)
+        version = reader_adapter.load_policy_delta(reader.get_model(), version)
+        self.assertIn(["frank", "data6", "read"], reader.get_policy())
+        self.assertRaises(
+            ValueError, reader_adapter.load_policy_delta, reader.get_model(), 0
+        )
+
+    def test_change_log_generators(self):
+        engine = create_engine("sqlite://")
+        adapter = Adapter(engine, change_log=True)
+        reader = Adapter(engine, change_log=True)
+        model = casbin.Enforcer(
+            str(Path(__file__).parent / "rbac_model.conf"), reader
+        ).get_model()
+
+        # rules passed as generators are written and logged
+        adapter.add_policies("p", "p", (r for r in [["alice", "data1", "read"]]))
+        adapter.add_policies("p", "p", (r for r in [["bob", "data2", "read"]]))
+        adapter.remove_policies("p", "p", (r for r in [["bob", "data2", "read"]]))
+        adapter.update_policies(
+            "p",
+            "p",
+            (r for r in [["alice", "data1", "read"]]),
+            (r for r in [["alice", "data1", "write"]]),
+        )
+        adapter.update_filtered_policies(
+            "p", "p", (r for r in [["carol", "data3", "read"]]), 0, "nobody"
+        )
+        self.assertEqual(adapter.current_version(), 6)
+        reader.load_policy_delta(model, 0)
+        self.assertEqual(
+            sorted(model.get_policy("p", "p")),
+            [["alice", "data1", "write"], ["carol", "data3", "read"]],
+        )
+
+    def test_change_log_versions(self):
+        engine = create_engine("sqlite://")
+        adapter = Adapter(engine, change_log=True)
+        adapter.add_policies("p", "p", [["alice", "data1", "read"], ["bob", "data2"]])
+        self.assertEqual(adapter.current_version(), 2)
+
+        # versions are allocated from the locked counter row
+        with engine.begin() as conn:
+            conn.exec_driver_sql("UPDATE casbin_rule_change_version SET version = 10")
+        adapter.add_policy("p", "p", ["eve", "data3", "read"])
+        self.assertEqual(adapter.current_version(), 11)
+
+        # a missing counter continues from the latest logged version
+        with engine.begin() as conn:
+            conn.exec_driver_sql("DELETE FROM casbin_rule_change_version")
+        adapter.remove_policy("p", "p", ["eve", "data3", "read"])
+        self.assertEqual(adapter.current_version(), 12)
+        with engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql(
+                    "SELECT version FROM casbin_rule_change_version"
+                ).scalar(),
+                12,
+            )
+
+    def test_snapshot(self):
+        engine = create_engine("sqlite://")
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            snapshot_path = os.path.join(tmpdir, "policy.snapshot")
+            writer = casbin.Enforcer(model_path, Adapter(engine))
+            writer.add_policies([["alice", "data1", "read"], ["bob", "data2", "write"]])
+            writer.add_grouping_policy("alice", "admin")
+
+            e = casbin.Enforcer(
+                model_path, Adapter(engine, snapshot_path=snapshot_path)
+            )
+            self.assertTrue(os.path.exists(snapshot_path))
+
+            with recorded_statements(engine) as statements:
+                e.load_policy()
+            # only the fingerprint is read from the database
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(
+                e.get_policy(), [["alice", "data1", "read"], ["bob", "data2", "write"]]
+            )
+            self.assertTrue(e.has_grouping_policy("alice", "admin"))
+
+            writer.add_policy("eve", "data3", "read")
+            e.load_policy()
+            self.assertTrue(e.enforce("eve", "data3", "read"))
+
+            e.update_policy(["eve", "data3", "read"], ["eve", "data3", "write"])
+            e.load_policy()
+            self.assertTrue(e.enforce("eve", "data3", "write"))
+
+            # local writes invalidate the snapshot, even when the row id of a removed
+            # rule is reused and the fingerprint stays the same
+            e.remove_policy("eve", "data3", "write")
+            e.add_policy("frank", "data4", "read")
+            e.load_policy()
+            self.assertFalse(e.enforce("eve", "data3", "write"))
+            self.assertTrue(e.enforce("frank", "data4", "read"))
+
+            e.remove_filtered_policy(0, "frank")
+            e.add_policy("gina", "data5", "read")
+            e.load_policy()
+            self.assertFalse(e.enforce("frank", "data4", "read"))
+            self.assertTrue(e.enforce("gina", "data5", "read"))
+
+            adapter = e.get_adapter()
+            session = sessionmaker(bind=engine)()
+            with adapter.using(session):
+                adapter.remove_policy("p", "p", ["gina", "data5", "read"])
+                for i in range(100):
+                    adapter.add_policy("p", "p", ["hank", "data6", "read"])
+            # one listener per session, however many writes
+            self.assertEqual(len(session.dispatch.after_commit), 1)
+            e.load_policy()
+            session.commit()
+            session.close()
+            e.load_policy()
+            self.assertFalse(e.enforce("gina", "data5", "read"))
+            self.assertTrue(e.enforce("hank", "data6", "read"))
+
+    def test_policy_store(self):
+        engine = create_engine("sqlite://")
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = casbin.Enforcer(model_path, Adapter(engine))
+            writer.add_policies([["alice", "data1", "read"], ["bob", "data2", "write"]])
+            writer.add_grouping_policy("alice", "admin")
+
+            with self.assertRaises(ValueError):
+                Adapter(engine, snapshot_path="policy.snapshot", policy_store=tmpdir)
+
+            # the first worker publishes version 1
+            first = casbin.Enforcer(model_path, Adapter(engine, policy_store=tmpdir))
+            self.assertEqual(first.adapter.policy_store.version(), 1)
+
+            with recorded_statements(engine) as statements:
+                second = casbin.Enforcer(
+                    model_path,
+                    Adapter(engine, create_all_models=False, policy_store=tmpdir),
+                )
+            self.assertEqual(statements, [])
+            self.assertEqual(
+                second.get_policy(),
+                [["alice", "data1", "read"], ["bob", "data2", "write"]],
+            )
+            self.assertTrue(second.has_grouping_policy("alice", "admin"))
+
+            writer.add_policy("eve", "data3", "read")
+            self.assertFalse(second.adapter.policy_store_changed())
+            self.assertEqual(first.adapter.publish_policy(), 2)
+            self.assertTrue(second.adapter.policy_store_changed())
+            second.load_policy()
+            self.assertFalse(second.adapter.policy_store_changed())
+            self.assertTrue(second.enforce("eve", "data3", "read"))
+
+            # a reload after a write through the adapter publishes a new version
+            second.add_policy("frank", "data4", "read")
+            second.load_policy()
+            self.assertTrue(second.enforce("frank", "data4", "read"))
+            self.assertEqual(second.adapter.policy_store.version(), 3)
+            self.assertTrue(first.adapter.policy_store_changed())
+            first.load_policy()
+            self.assertTrue(first.enforce("frank", "data4", "read"))
+
+            # older segments are pruned
+            first.adapter.publish_policy()
+            segments = [n for n in os.listdir(tmpdir) if n.startswith("segment-")]
+            self.assertEqual(sorted(n.split("-")[1] for n in segments), ["3", "4"])
+
+    def test_load_filtered_policies(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        rules = [
+            ["tenant{}_user{}".format(t, u), "tenant{}".format(t), "read"]
+            for t in range(8)
+            for u in range(50)
+        ]
+
+        for url in ("sqlite:///{}/policy.db", "sqlite://"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                engine = create_engine(url.format(tmpdir))
+                adapter = Adapter(engine, filtered=True)
+                adapter.add_policies("p", "p", rules)
+
+                filter = Filter()
+                filter.ptype = ["p"]
+                tenants = ["tenant{}".format(t) for t in range(8)]
+                enforcers = [casbin.Enforcer(model_path, adapter) for _ in tenants]
+                adapter.load_filtered_policies(
+                    zip(
+                        (e.get_model() for e in enforcers),
+                        filter.partition("v1", tenants),
+                    ),
+                    max_workers=4,
+                )
+                for t, e in enumerate(enforcers):
+                    self.assertEqual(e.get_policy(), rules[t * 50 : (t + 1) * 50])
+                    self.assertTrue(
+                        e.enforce("tenant{}_user7".format(t), tenants[t], "read")
+                    )
+                self.assertTrue(adapter.is_filtered())
+                engine.dispose()
+
+    def test_load_filtered_policies_metrics(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        rules = [
+            ["tenant{}_user{}".format(t, u), "tenant{}".format(t), "read"]
+            for t in range(8)
+            for u in range(50)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine("sqlite:///{}/policy.db".format(tmpdir))
+            metrics = AdapterMetrics()
+            adapter = Adapter(engine, filtered=True, metrics=metrics)
+            adapter.add_policies("p", "p", rules)
+
+            filter = Filter()
+            filter.ptype = ["p"]
+            tenants = ["tenant{}".format(t) for t in range(8)]
+            models = [casbin.Enforcer(model_path).get_model() for _ in tenants]
+            adapter.load_filtered_policies(
+                zip(models, filter.partition("v1", tenants)), max_workers=4
+            )
+            # the queries run on worker threads and count to the operation
+            stats = metrics.stats()["operations"]["load_filtered_policies"]
+            self.assertEqual(stats["calls"], 1)
+            self.assertGreaterEqual(stats["statements"], len(tenants))
+            self.assertEqual(stats["rows_read"], len(rules))
+            engine.dispose()
+
+    def test_load_policy_parallel(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        rules = [
+            ["user{}".format(i), "data{}".format(i % 7), "read"] for i in range(1000)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine("sqlite:///{}/policy.db".format(tmpdir))
+            adapter = Adapter(engine, load_workers=3)
+            e = casbin.Enforcer(model_path, adapter)
+            self.assertEqual(e.get_policy(), [])
+
+            adapter.add_policies("p", "p", rules)
+            adapter.add_policies("g", "g", [["user1", "admin"], ["user2", "admin"]])
+            # leave gaps in the ids
+            adapter.remove_policies("p", "p", rules[100:400])
+            adapter.remove_policy("g", "g", ["user1", "admin"])
+
+            e.load_policy()
+            self.assertEqual(e.get_policy(), rules[:100] + rules[400:])
+            self.assertEqual(e.get_grouping_policy(), [["user2", "admin"]])
+            engine.dispose()
+
+    def test_load_policy_parallel_metrics(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        rules = [
+            ["user{}".format(i), "data{}".format(i % 7), "read"] for i in range(5000)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine("sqlite:///{}/policy.db".format(tmpdir))
+            metrics = AdapterMetrics()
+            adapter = Adapter(engine, load_workers=4, metrics=metrics)
+            adapter.add_policies("p", "p", rules)
+
+            model = casbin.Enforcer(model_path).get_model()
+            adapter.load_policy(model)
+            stats = metrics.stats()["operations"]["load_policy"]
+            # the id range query and one query per range
+            self.assertEqual(stats["statements"], 1 + 4 * 4)
+            self.assertEqual(stats["rows_read"], len(rules))
+            engine.dispose()
+
+    def test_create_table(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            url = "sqlite:///{}/policy.db".format(tmpdir)
+            engine = create_engine(url)
+            with recorded_statements(engine) as statements:
+                Adapter(engine)
+            self.assertTrue(statements)
+            engine.dispose()
+
+            # the schema is known to exist, also for new engines of the database
+            engine = create_engine(url)
+            with recorded_statements(engine) as statements:
+                adapter = Adapter(engine)
+            self.assertEqual(statements, [])
+            adapter.add_policy("p", "p", ["alice", "data1", "read"])
+            # an explicit call checks again
+            with recorded_statements(engine) as statements:
+                adapter.create_table()
+            self.assertTrue(statements)
+            engine.dispose()
+
+    def test_sqlite_profile(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            url = "sqlite:///{}/policy.db".format(tmpdir)
+            adapter = Adapter(url, sqlite_profile={"cache_size": -1000})
+            adapter.add_policy("p", "p", ["alice", "data1", "read"])
+            engine = adapter._engine
+            self.assertIsInstance(engine.pool, QueuePool)
+            with engine.connect() as conn:
+                pragmas = [
+                    conn.exec_driver_sql("PRAGMA " + name).scalar()
+                    for name in ("journal_mode", "synchronous", "cache_size")
+                ]
+                self.assertEqual(pragmas, ["wal", 1, -1000])
+
+            # one listener per engine, however many adapters apply the profile
+            listeners = len(engine.pool.dispatch.connect)
+            for _ in range(5):
+                Adapter(engine, sqlite_profile={"cache_size": -2000})
+            self.assertEqual(len(engine.pool.dispatch.connect), listeners)
+            engine.dispose()
+            with engine.connect() as conn:
+                self.assertEqual(
+                    conn.exec_driver_sql("PRAGMA cache_size").scalar(), -2000
+                )
+            engine.dispose()
+
+            # engines passed in get the pragmas on their new connections
+            engine = create_engine(url)
+            Adapter(engine, sqlite_profile=True)
+            with engine.connect() as conn:
+                timeout = conn.exec_driver_sql("PRAGMA busy_timeout").scalar()
+                self.assertEqual(timeout, 5000)
+            engine.dispose()
+
+    def test_read_engines(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [os.path.join(tmpdir, name) for name in ("a.db", "b.db", "c.db")]
+            primary, replica1, replica2 = (
+                create_engine("sqlite:///" + path) for path in paths
+            )
+            Adapter(primary).add_policy("p", "p", ["alice", "data1", "read"])
+            # the replicas are copies of the primary, the second one ahead of the first
+            primary.dispose()
+            shutil.copy(paths[0], paths[1])
+            shutil.copy(paths[0], paths[2])
+            Adapter(replica2).add_policy("p", "p", ["bob", "data2", "read"])
+
+            def loaded(adapter):
+                e = casbin.Enforcer(model_path, adapter)
+                return [rule[0] for rule in e.get_policy()]
+
+            adapter = Adapter(primary, read_engines=[replica1, replica2])
+            self.assertEqual(loaded(adapter), ["alice"])
+            self.assertEqual(loaded(adapter), ["alice", "bob"])
+            self.assertEqual(loaded(adapter), ["alice"])
+
+            adapter = Adapter(
+                primary,
+                read_engines=[replica1, replica2],
+                read_engine_selector=lambda engines: engines[1],
+            )
+            self.assertEqual(loaded(adapter), ["alice", "bob"])
+            self.assertEqual(loaded(adapter), ["alice", "bob"])
+
+            # writes go to the primary, which serves reads for read_your_writes seconds
+            adapter = Adapter(primary, read_engines=[replica1], read_your_writes=60)
+            self.assertEqual(loaded(adapter), ["alice"])
+            adapter.add_policy("p", "p", ["eve", "data3", "read"])
+            self.assertEqual(loaded(adapter), ["alice", "eve"])
+            adapter._read_your_writes = 0
+            self.assertEqual(loaded(adapter), ["alice"])
+
+            for engine in (primary, replica1, replica2):
+                engine.dispose()
+
+    def test_write_buffer(self):
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        rules = [["user{}".format(i), "data1", "read"] for i in range(250)]
+
+        for url in ("sqlite:///{}/policy.db", "sqlite://"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                engine = create_engine(url.format(tmpdir))
+                errors = []
+                adapter = Adapter(
+                    engine,
+                    write_buffer_size=100,
+                    write_buffer_interval=60,
+                    on_flush_error=errors.append,
+                )
+                e = casbin.Enforcer(model_path, adapter)
+                for rule in rules:
+                    e.add_policy(*rule)
+                # opposing operations on buffered rules are coalesced
+                e.remove_policy(*rules[249])
+                e.remove_policy(*rules[0])
+                e.add_policy(*rules[0])
+                adapter.flush()
+
+                with engine.connect() as conn:
+                    stored = conn.exec_driver_sql(
+                        "SELECT v0 FROM casbin_rule ORDER BY id"
+                    ).scalars()
+                    self.assertCountEqual(
+                        list(stored), ["user{}".format(i) for i in range(249)]
+                    )
+
+                # other operations write the buffer first
+                e.add_policy("eve", "data2", "write")
+                e.load_policy()
+                self.assertTrue(e.enforce("eve", "data2", "write"))
+                self.assertEqual(len(e.get_policy()), 250)
+
+                def fail(session, rows):
+                    raise RuntimeError("insert failed")
+
+                adapter._bulk_insert = fail
+                e.add_policy("mallory", "data3", "read")
+                with self.assertRaises(FlushError) as cm:
+                    adapter.close()
+                self.assertEqual(
+                    cm.exception.operations, {("p", "mallory", "data3", "read"): "add"}
+                )
+                self.assertEqual(errors, [])
+                with self.assertRaises(RuntimeError):
+                    adapter.add_policy("p", "p", ["mallory", "data3", "read"])
+                engine.dispose()
+
+    def test_write_buffer_remove_stored(self):
+        engine = create_engine("sqlite://")
+        # stored by another node
+        Adapter(engine).add_policy("p", "p", ["alice", "data1", "read"])
+
+        adapter = Adapter(engine, write_buffer_size=100, write_buffer_interval=60)
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.remove_policy("p", "p", ["alice", "data1", "read"])
+        adapter.close()
+
+        # the removal deletes the stored rule, as it does unbuffered
+        with engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql("SELECT COUNT(*) FROM casbin_rule").scalar(), 0
+            )
+
+    def test_using(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+        engine = adapter._engine
+
+        session = sessionmaker(bind=engine)()
+        with adapter.using(session):
+            e.add_policy("eve", "data3", "read")
+            e.remove_policy("alice", "data1", "read")
+            e.load_policy()
+            self.assertTrue(e.enforce("eve", "data3", "read"))
+            self.assertFalse(e.enforce("alice", "data1", "read"))
+        # no cached policy to invalidate when the caller commits
+        self.assertEqual(len(session.dispatch.after_commit), 0)
+        session.rollback()
+        session.close()
+
+        e.load_policy()
+        self.assertFalse(e.enforce("eve", "data3", "read"))
+        self.assertTrue(e.enforce("alice", "data1", "read"))
+
+        with engine.connect() as conn:
+            with adapter.using(conn):
+                e.add_policies([["eve", "data3", "read"], ["eve", "data4", "read"]])
+                e.update_policy(["eve", "data4", "read"], ["eve", "data4", "write"])
+            conn.commit()
+
+        e.load_policy()
+        self.assertTrue(e.enforce("eve", "data3", "read"))
+        self.assertTrue(e.enforce("eve", "data4", "write"))
+
+    def test_metrics(self):
+        engine = create_engine("sqlite://")
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = str(scriptdir / "rbac_model.conf")
+        events = []
+        metrics = AdapterMetrics(callback=events.append)
+        e = casbin.Enforcer(model_path, Adapter(engine, metrics=metrics))
+
+        e.add_policies([["alice", "data1", "read"], ["bob", "data2", "write"]])
+        e.remove_filtered_policy(0, "bob")
+        e.load_policy()
+        # statements of other users of the engine are not counted
+        with engine.begin() as conn:
+            conn.exec_driver_sql("SELECT 1")
+
+        stats = e.get_adapter().stats()
+        operations = stats["operations"]
+        self.assertEqual(operations["add_policies"]["calls"], 1)
+        self.assertEqual(operations["add_policies"]["statements"], 1)
+        self.assertEqual(operations["add_policies"]["rows_written"], 2)
+        self.assertEqual(operations["remove_filtered_policy"]["rows_written"], 1)
+        self.assertEqual(operations["load_policy"]["rows_read"], 1)
+        self.assertEqual(operations["load_policy"]["latency"]["count"], 2)
+        self.assertEqual(
+            operations["load_policy"]["latency"]["buckets"][-1], (float("inf"), 2)
+        )
+        self.assertEqual(stats["transactions"]["commits"], 4)
+        self.assertEqual(
+            [event["operation"] for event in events],
+            ["load_policy", "add_policies", "remove_filtered_policy", "load_policy"],
+        )
+        self.assertEqual(events[1]["rows_written"], 2)
+        self.assertFalse(events[1]["error"])
+
+        with self.assertRaises(Exception):
+            e.get_adapter().update_policy(
+                "p", "p", ["eve", "data9", "read"], ["eve", "data9", "write"]
+            )
+        stats = metrics.stats()
+        self.assertEqual(stats["operations"]["update_policy"]["errors"], 1)
+        self.assertEqual(stats["transactions"]["rollbacks"], 1)
+
+        with self.assertRaises(ValueError):
+            Adapter(engine).stats()
+
     def test_str(self):
         rule = CasbinRule(ptype="p", v0="alice", v1="data1", v2="read")
         self.assertEqual(str(rule), "p, alice, data1, read")
@@ -364,6 +1350,52 @@ class TestConfig(TestCase):
         self.assertFalse(e.enforce("data2_admin", "data2", "write"))
         self.assertTrue(e.enforce("data2_admin", "data_test", "write"))
 
+    def test_update_policies_not_found(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+
+        not_found = adapter.update_policies(
+            "p",
+            "p",
+            [
+                ["alice", "data1", "read"],
+                ["eve", "data9", "read"],
+                ["bob", "data2", "write"],
+            ],
+            [
+                ["alice", "data1", "write"],
+                ["eve", "data9", "write"],
+                ["bob", "data3", "read"],
+            ],
+        )
+        self.assertEqual(not_found, [["eve", "data9", "read"]])
+
+        e.load_policy()
+        self.assertTrue(e.enforce("alice", "data1", "write"))
+        self.assertFalse(e.enforce("alice", "data1", "read"))
+        self.assertIn(["bob", "data3", "read"], e.get_policy())
+        self.assertNotIn(["eve", "data9", "write"], e.get_policy())
+
+    def test_cached_statements(self):
+        e = self.get_enforcer()
+        adapter = e.get_adapter()
+
+        self.assertTrue(adapter.remove_policy("p", "p", ["alice", "data1", "read"]))
+        self.assertTrue(adapter.remove_policy("p", "p", ["bob", "data2", "write"]))
+        self.assertFalse(adapter.remove_policy("p", "p", ["bob", "data2", "write"]))
+        self.assertEqual(
+            [key for key in adapter._statements if key[0] == "remove"], [("remove", 3)]
+        )
+
+        with self.assertRaises(NoResultFound):
+            adapter.update_policy("p", "p", ["eve", "data9"], ["eve", "data8"])
+        with self.assertRaises(MultipleResultsFound):
+            adapter.update_policy("p", "p", ["data2_admin"], ["data3_admin"])
+        adapter.update_policy("p", "p", ["data2_admin", "data2", "read"], ["carol"])
+
+        e.load_policy()
+        self.assertEqual(e.get_policy(), [["carol"], ["data2_admin", "data2", "write"]])
+
     def test_update_filtered_policies(self):
         e = self.get_enforcer()
 
@@ -383,3 +1415,55 @@ class TestConfig(TestCase):
 
         e.update_filtered_policies([["bob", "data2", "read"]], 0, "bob")
         self.assertTrue(e.enforce("bob", "data2", "read"))
+
+        # the replacements are stored, and the replaced rules returned
+        e.load_policy()
+        self.assertEqual(
+            sorted(e.get_policy()),
+            [
+                ["alice", "data1", "write"],
+                ["bob", "data2", "read"],
+                ["data2_admin", "data3", "read"],
+                ["data2_admin", "data3", "write"],
+            ],
+        )
+        self.assertEqual(
+            e.adapter.update_filtered_policies(
+                "p", "p", [["bob", "data2", "write"]], 0, "bob"
+            ),
+            [["bob", "data2", "read"]],
+        )
+
+    def test_remove_returning(self):
+        for returning in (True, False):
+            e = self.get_enforcer()
+            adapter = e.adapter
+            if not returning:
+                # the locked select-then-delete of databases without RETURNING
+                adapter._supports_returning = lambda: False
+            with recorded_statements(adapter._engine) as statements:
+                removed = adapter.remove_filtered_policy_returning(
+                    "p", "p", 0, "data2_admin"
+                )
+            self.assertEqual(
+                sorted(removed),
+                [["data2_admin", "data2", "read"], ["data2_admin", "data2", "write"]],
+            )
+            self.assertEqual(len(statements), 1 if returning else 2)
+
+            self.assertEqual(
+                adapter.remove_policies_returning(
+                    "p",
+                    "p",
+                    [["alice", "data1", "read"], ["alice", "data1", "write"]],
+                ),
+                [["alice", "data1", "read"]],
+            )
+            self.assertEqual(
+                adapter.remove_filtered_policy_returning("p", "p", 1, "data9"), []
+            )
+            self.assertEqual(
+                adapter.remove_filtered_policy_returning("p", "p", 6, "x"), []
+            )
+            e.load_policy()
+            self.assertEqual(e.get_policy(), [["bob", "data2", "write"]])
@@ -9,7 +9,7 @@ from casbin_sqlalchemy_adapter import Adapter
 from casbin_sqlalchemy_adapter import Base
 from casbin_sqlalchemy_adapter.adapter import Filter
 
-from tests.test_adapter import TestConfig
+from tests.test_adapter import TestConfig, recorded_statements
 
 
 class CasbinRuleSoftDelete(Base):
@@ -156,3 +156,64 @@ class TestConfigSoftDelete(TestConfig):
             .first()
             .is_deleted
         )
+
+    def test_save_policy_softdelete_bulk(self):
+        e = self.get_enforcer()
+        session = e.adapter.session_local()
+        e.enable_auto_save(auto_save=False)
+
+        e.delete_permission_for_user("alice", "data1", "read")
+        e.add_policies([["user{}".format(i), "data1", "read"] for i in range(3000)])
+
+        with recorded_statements(e.adapter._engine) as statements:
+            e.save_policy()
+
+        # one select, a few chunked inserts and one update, not one query per rule
+        self.assertLess(len(statements), 10)
+        self.assertTrue(
+            query_for_rule(session, e.adapter, "p", "alice", "data1", "read")
+            .first()
+            .is_deleted
+        )
+        self.assertFalse(
+            query_for_rule(session, e.adapter, "p", "user2999", "data1", "read")
+            .first()
+            .is_deleted
+        )
+        self.assertEqual(
+            query_for_rule(session, e.adapter, "p", "bob", "data2", "write").count(), 1
+        )
+
+    def test_unique_rules_softdelete(self):
+        class UniqueRuleSoftDelete(Base):
+            __tablename__ = "casbin_rule_unique_soft_delete"
+            __table_args__ = {"extend_existing": True}
+
+            id = Column(Integer, primary_key=True)
+            ptype = Column(String(255))
+            v0 = Column(String(255))
+            v1 = Column(String(255))
+            v2 = Column(String(255))
+            v3 = Column(String(255))
+            v4 = Column(String(255))
+            v5 = Column(String(255))
+            is_deleted = Column(Boolean, default=False, nullable=False)
+
+        engine = create_engine("sqlite://")
+        adapter = Adapter(
+            engine,
+            UniqueRuleSoftDelete,
+            UniqueRuleSoftDelete.is_deleted,
+            unique_rules=True,
+        )
+
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+        adapter.remove_policy("p", "p", ["alice", "data1", "read"])
+        # a deleted rule does not block adding it again
+        adapter.add_policy("p", "p", ["alice", "data1", "read"])
+
+        s = sessionmaker(bind=engine)()
+        rules = s.query(UniqueRuleSoftDelete).order_by(UniqueRuleSoftDelete.id).all()
+        self.assertEqual([rule.is_deleted for rule in rules], [True, False])
+        s.close()
@@ -0,0 +1,196 @@
+import os
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+
+import casbin
+from sqlalchemy import Boolean, Column, Integer, String, insert, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from casbin_sqlalchemy_adapter import AsyncAdapter
+from casbin_sqlalchemy_adapter import Base
+from casbin_sqlalchemy_adapter import CasbinRule
+from casbin_sqlalchemy_adapter.adapter import Filter
+
+
+class CasbinRuleAsyncSoftDelete(Base):
+    __tablename__ = "casbin_rule_async_soft_delete"
+
+    id = Column(Integer, primary_key=True)
+    ptype = Column(String(255))
+    v0 = Column(String(255))
+    v1 = Column(String(255))
+    v2 = Column(String(255))
+    v3 = Column(String(255))
+    v4 = Column(String(255))
+    v5 = Column(String(255))
+
+    is_deleted = Column(Boolean, default=False, index=True, nullable=False)
+
+
+class TestAsyncConfig(IsolatedAsyncioTestCase):
+    db_class = CasbinRule
+
+    def get_adapter(self, engine):
+        return AsyncAdapter(engine)
+
+    async def get_enforcer(self):
+        engine = create_async_engine("sqlite+aiosqlite://")
+        adapter = self.get_adapter(engine)
+        await adapter.create_table()
+
+        async with engine.begin() as conn:
+            await conn.execute(
+                insert(self.db_class),
+                [
+                    dict(ptype="p", v0="alice", v1="data1", v2="read"),
+                    dict(ptype="p", v0="bob", v1="data2", v2="write"),
+                    dict(ptype="p", v0="data2_admin", v1="data2", v2="read"),
+                    dict(ptype="p", v0="data2_admin", v1="data2", v2="write"),
+                    dict(ptype="g", v0="alice", v1="data2_admin", v2=None),
+                ],
+            )
+
+        scriptdir = Path(os.path.dirname(os.path.realpath(__file__)))
+        model_path = scriptdir / "rbac_model.conf"
+
+        e = casbin.AsyncEnforcer(str(model_path), adapter)
+        await e.load_policy()
+        return e
+
+    async def test_enforcer_basic(self):
+        e = await self.get_enforcer()
+
+        self.assertTrue(e.enforce("alice", "data1", "read"))
+        self.assertFalse(e.enforce("alice", "data1", "write"))
+        self.assertFalse(e.enforce("bob", "data1", "read"))
+        self.assertTrue(e.enforce("bob", "data2", "write"))
+        self.assertTrue(e.enforce("alice", "data2", "read"))
+        self.assertTrue(e.enforce("alice", "data2", "write"))
+
+    async def test_add_policies(self):
+        e = await self.get_enforcer()
+
+        self.assertFalse(e.enforce("eve", "data3", "read"))
+        await e.add_policy("eve", "data3", "read")
+        await e.add_policies((("eve", "data4", "read"), ("eve", "data5", "read")))
+        await e.load_policy()
+        self.assertTrue(e.enforce("eve", "data3", "read"))
+        self.assertTrue(e.enforce("eve", "data4", "read"))
+        self.assertTrue(e.enforce("eve", "data5", "read"))
+
+    async def test_save_policy(self):
+        e = await self.get_enforcer()
+        model = e.get_model()
+        model.clear_policy()
+        model.add_policy("p", "p", ["alice", "data4", "read"])
+
+        await e.get_adapter().save_policy(model)
+        await e.load_policy()
+        self.assertEqual(e.get_policy(), [["alice", "data4", "read"]])
+
+    async def test_remove_policies(self):
+        e = await self.get_enforcer()
+
+        await e.remove_policy("alice", "data1", "read")
+        await e.remove_policies((("bob", "data2", "write"), ("alice", "data2", "read")))
+        await e.remove_filtered_policy(1, "data2", "write")
+        await e.load_policy()
+        self.assertEqual(e.get_policy(), [["data2_admin", "data2", "read"]])
+
+    async def test_update_policies(self):
+        e = await self.get_enforcer()
+
+        await e.update_policy(["alice", "data1", "read"], ["alice", "data1", "write"])
+        await e.update_policies(
+            [["bob", "data2", "write"], ["data2_admin", "data2", "read"]],
+            [["bob", "data3", "write"], ["data2_admin", "data3", "read"]],
+        )
+        await e.load_policy()
+        self.assertTrue(e.enforce("alice", "data1", "write"))
+        self.assertFalse(e.enforce("alice", "data1", "read"))
+        self.assertTrue(e.enforce("bob", "data3", "write"))
+        self.assertTrue(e.enforce("data2_admin", "data3", "read"))
+
+    async def test_update_filtered_policies(self):
+        e = await self.get_enforcer()
+
+        await e.update_filtered_policies(
+            [["data2_admin", "data3", "read"], ["data2_admin", "data3", "write"]],
+            0,
+            "data2_admin",
+        )
+        await e.load_policy()
+        self.assertTrue(e.enforce("data2_admin", "data3", "read"))
+        self.assertTrue(e.enforce("data2_admin", "data3", "write"))
+        self.assertFalse(e.enforce("data2_admin", "data2", "read"))
+
+    async def test_remove_returning(self):
+        e = await self.get_enforcer()
+        adapter = e.get_adapter()
+
+        removed = await adapter.remove_filtered_policy_returning(
+            "p", "p", 0, "data2_admin"
+        )
+        self.assertEqual(
+            sorted(removed),
+            [["data2_admin", "data2", "read"], ["data2_admin", "data2", "write"]],
+        )
+        # the locked select-then-delete of databases without RETURNING
+        adapter._supports_returning = lambda: False
+        self.assertEqual(
+            await adapter.remove_policies_returning(
+                "p", "p", [["alice", "data1", "read"], ["alice", "data1", "write"]]
+            ),
+            [["alice", "data1", "read"]],
+        )
+        await e.load_policy()
+        self.assertEqual(e.get_policy(), [["bob", "data2", "write"]])
+
+    async def test_filtered_policy(self):
+        e = await self.get_enforcer()
+        filter = Filter()
+
+        filter.ptype = ["p"]
+        filter.v0 = ["bob"]
+        await e.load_filtered_policy(filter)
+        self.assertTrue(e.is_filtered())
+        self.assertEqual(e.get_policy(), [["bob", "data2", "write"]])
+        self.assertEqual(e.get_grouping_policy(), [])
+
+    async def test_using(self):
+        e = await self.get_enforcer()
+        adapter = e.get_adapter()
+
+        async with adapter.session_local() as session:
+            with adapter.using(session):
+                await e.add_policy("eve", "data3", "read")
+                await e.remove_policy("alice", "data1", "read")
+                await e.load_policy()
+                self.assertTrue(e.enforce("eve", "data3", "read"))
+            await session.rollback()
+
+        await e.load_policy()
+        self.assertFalse(e.enforce("eve", "data3", "read"))
+        self.assertTrue(e.enforce("alice", "data1", "read"))
+
+
+class TestAsyncConfigSoftDelete(TestAsyncConfig):
+    db_class = CasbinRuleAsyncSoftDelete
+
+    def get_adapter(self, engine):
+        return AsyncAdapter(
+            engine, CasbinRuleAsyncSoftDelete, CasbinRuleAsyncSoftDelete.is_deleted
+        )
+
+    async def test_softdelete_flag(self):
+        e = await self.get_enforcer()
+
+        await e.remove_policy("alice", "data1", "read")
+        async with e.get_adapter()._session_scope() as session:
+            result = await session.execute(
+                select(CasbinRuleAsyncSoftDelete.is_deleted).where(
+                    CasbinRuleAsyncSoftDelete.v0 == "alice",
+                    CasbinRuleAsyncSoftDelete.v1 == "data1",
+                )
+            )
+            self.assertEqual(result.scalars().all(), [True])